@@ -0,0 +1,170 @@
+import os
+import time
+import sqlite3
+import threading
+from collections import OrderedDict
+from qgiscommons2.settings import pluginSetting
+
+class TileCache():
+
+    '''
+    Stores the files retrieved from endpoints in a SQLite database, so they don't have to
+    be downloaded again. Each file is identified by the url of the endpoint, the
+    coverage, the time position and a string that identifies the tile.
+
+    When the total size of the stored files exceeds maxSize (in bytes), the least
+    recently used ones are removed
+    '''
+
+    def __init__(self, filename, maxSize):
+        self.filename = filename
+        self.maxSize = maxSize
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = None
+
+    def _connection(self):
+        if self._conn is None:
+            folder = os.path.dirname(self.filename)
+            if not os.path.exists(folder):
+                os.makedirs(folder)
+            self._conn = sqlite3.connect(self.filename, timeout=30, check_same_thread=False)
+            self._conn.execute("PRAGMA auto_vacuum = FULL")
+            self._conn.execute('''CREATE TABLE IF NOT EXISTS tiles (url TEXT, coverage TEXT, time TEXT,
+                                tile TEXT, data BLOB, size INTEGER, lastaccess REAL,
+                                PRIMARY KEY (url, coverage, time, tile))''')
+            self._conn.execute("CREATE INDEX IF NOT EXISTS lastaccess_idx ON tiles (lastaccess)")
+            self._conn.commit()
+        return self._conn
+
+    def get(self, key, filename):
+        '''Writes the file stored for the passed key to filename. Returns False if
+        there is no file for that key in the cache'''
+        if not self.maxSize:
+            return False
+        with self._lock:
+            conn = self._connection()
+            row = conn.execute("SELECT data FROM tiles WHERE url=? AND coverage=? AND time=? AND tile=?",
+                               key).fetchone()
+            if row is None:
+                self.misses += 1
+                return False
+            conn.execute("UPDATE tiles SET lastaccess=? WHERE url=? AND coverage=? AND time=? AND tile=?",
+                         (time.time(),) + tuple(key))
+            conn.commit()
+            self.hits += 1
+        with open(filename, "wb") as f:
+            f.write(row[0])
+        return True
+
+    def put(self, key, filename):
+        if not self.maxSize:
+            return
+        with open(filename, "rb") as f:
+            data = f.read()
+        with self._lock:
+            conn = self._connection()
+            conn.execute("INSERT OR REPLACE INTO tiles VALUES (?, ?, ?, ?, ?, ?, ?)",
+                         tuple(key) + (sqlite3.Binary(data), len(data), time.time()))
+            self._evict(conn)
+            conn.commit()
+
+    def _evict(self, conn):
+        total = conn.execute("SELECT SUM(size) FROM tiles").fetchone()[0] or 0
+        if total <= self.maxSize:
+            return
+        toDelete = []
+        for rowid, size in conn.execute("SELECT rowid, size FROM tiles ORDER BY lastaccess"):
+            if total <= self.maxSize:
+                break
+            toDelete.append((rowid,))
+            total -= size
+        conn.executemany("DELETE FROM tiles WHERE rowid=?", toDelete)
+
+    def stats(self):
+        '''Returns a dict with the number of hits and misses since the cache was
+        opened, and the number of tiles and total size of the cache'''
+        with self._lock:
+            count, size = self._connection().execute("SELECT COUNT(*), SUM(size) FROM tiles").fetchone()
+        return {"hits": self.hits, "misses": self.misses, "count": count, "size": size or 0}
+
+    def clear(self):
+        with self._lock:
+            conn = self._connection()
+            conn.execute("DELETE FROM tiles")
+            conn.commit()
+        self.hits = 0
+        self.misses = 0
+
+class ValuesCache():
+
+    '''
+    Keeps in memory the band values most recently retrieved for plotting, so plotting
+    another parameter or another range of dates for the same pixel or region doesn't
+    retrieve them again. Values are arrays or lists of arrays, identified by the
+    dataset, the coverage, the time position and the extent they were read for.
+
+    When their total size exceeds maxSize (in bytes), the least recently used ones
+    are removed
+    '''
+
+    def __init__(self, maxSize):
+        self.maxSize = maxSize
+        self.size = 0
+        self._values = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _size(value):
+        if isinstance(value, list):
+            return sum(v.nbytes for v in value)
+        return value.nbytes
+
+    def get(self, key):
+        '''Returns the values stored for the passed key, or None if they are not in the cache'''
+        with self._lock:
+            value = self._values.pop(key, None)
+            if value is not None:
+                self._values[key] = value
+            return value
+
+    def put(self, key, value):
+        size = self._size(value)
+        with self._lock:
+            old = self._values.pop(key, None)
+            if old is not None:
+                self.size -= self._size(old)
+            if size > self.maxSize:
+                return
+            self._values[key] = value
+            self.size += size
+            while self.size > self.maxSize:
+                _, old = self._values.popitem(last=False)
+                self.size -= self._size(old)
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+            self.size = 0
+
+
+def cacheFolder():
+    return pluginSetting("cacheFolder") or os.path.join(os.path.expanduser("~"), ".qgis2", "datacubecache")
+
+_tileCache = None
+
+def tileCache():
+    '''Returns the tile cache shared by all layers, with the size set in the plugin settings'''
+    global _tileCache
+    if _tileCache is None:
+        _tileCache = TileCache(os.path.join(cacheFolder(), "tiles.sqlite"), 0)
+    _tileCache.maxSize = int(float(pluginSetting("tileCacheSize")) * 1024 * 1024)
+    return _tileCache
+
+_valuesCache = ValuesCache(0)
+
+def valuesCache():
+    '''Returns the cache of plot values, with the size set in the plugin settings'''
+    _valuesCache.maxSize = int(float(pluginSetting("plotCacheSize")) * 1024 * 1024)
+    return _valuesCache
@@ -1,14 +1,24 @@
 from qgis.core import QgsRasterLayer, QgsRasterFileWriter, QgsRasterPipe, QgsPoint, QgsRectangle
 from datacubeplugin.layers import uriFromComponents
-from qgiscommons2.files import tempFilename, tempFolderInTempFolder
-from qgiscommons2.gui import startProgressBar, closeProgressBar, setProgressValue
+from datacubeplugin.cache import tileCache, valuesCache
+from datacubeplugin.readers import datasets
+from qgiscommons2.files import tempFilename
+from qgiscommons2.settings import pluginSetting
 import owslib.wcs as wcs
+from owslib.util import ServiceException
 import os
+import logging
+import time as timelib
+from multiprocessing.pool import ThreadPool
+from collections import deque
 from dateutil import parser
 import json
 import math
+import numpy as np
 from qgis.PyQt.QtCore import pyqtSignal, QObject
 
+logger = logging.getLogger('datacube')
+
 class Layer():
 
     def __init__(self):
@@ -24,56 +34,269 @@ class Layer():
             return filename
 
     def _save(self, filename, extent=None):
-        filewriter = QgsRasterFileWriter(filename)
-        pipe = QgsRasterPipe()
+        key = self.cacheKey(extent)
+        if key is not None and tileCache().get(key, filename):
+            return
+        writeRaster(*self._writeArgs(filename, extent))
+        if key is not None:
+            tileCache().put(key, filename)
+
+    def cacheKey(self, extent=None, tileIndex=None):
+        '''Returns the key that identifies the data of this layer within the passed extent
+        in the tile cache, or None if it should not be cached. If the extent is a tile
+        of the layer grid, its index should be passed as well'''
+        return None
+
+    def valuesKey(self, extent):
+        '''Returns the key that identifies the band values of this layer within the passed
+        extent in the cache of plot values'''
+        return (self.datasetName(), self.coverageName(), self.time(),
+                (extent.xMinimum(), extent.yMinimum(), extent.xMaximum(), extent.yMaximum()))
+
+    def _writeArgs(self, filename, extent=None, maxSize=None):
+        '''Returns the arguments to pass to writeRaster to save the data within the
+        passed extent. It uses a copy of the provider of the layer, so it can be used
+        from a different thread. If maxSize is passed, the data is downsampled so its
+        width and height are not larger than that number of pixels'''
         layer = self.layer()
         provider = layer.dataProvider()
         extent = extent or layer.extent()
-        xSize = extent.width() / layer.rasterUnitsPerPixelX()
-        ySize = extent.height() / layer.rasterUnitsPerPixelY()
-        pipe.set(provider.clone())
-        filewriter.writeRaster(pipe, xSize, ySize, extent, provider.crs())
+        xSize = int(round(extent.width() / layer.rasterUnitsPerPixelX()))
+        ySize = int(round(extent.height() / layer.rasterUnitsPerPixelY()))
+        if maxSize is not None and max(xSize, ySize) > maxSize:
+            factor = float(maxSize) / max(xSize, ySize)
+            xSize = max(1, int(round(xSize * factor)))
+            ySize = max(1, int(round(ySize * factor)))
+        return filename, provider.clone(), xSize, ySize, extent, provider.crs()
 
     def saveTo(self, folder, extent=None):
         filename = os.path.join(folder, self.name().replace(":", "_") + ".tif")
         self._save(filename, extent)
 
     TILESIZE = 256
-    def saveTiles(self, _extent):
-        
-        folder = tempFolderInTempFolder()
+    def tiles(self, _extent):
+        '''
+        Returns the (x, y) index and extent of the tiles that cover the intersection
+        of the passed extent and the extent of the layer.
+
+        Tiles are taken from a grid of TILESIZE x TILESIZE pixels aligned with the pixels
+        of the layer and starting at its upper left corner, so the same tile always has
+        the same index and extent, whatever the requested extent is. Tiles in the right
+        and bottom edges are clipped to the extent of the layer
+        '''
         layer = self.layer()
-        if _extent.intersects(layer.extent()):
-            extent = _extent.intersect(layer.extent())
-            xSize = extent.width() / layer.rasterUnitsPerPixelX()
-            ySize = extent.height() / layer.rasterUnitsPerPixelY()
-            xTiles = math.ceil(xSize / self.TILESIZE)
-            yTiles = math.ceil(ySize / self.TILESIZE)
-            i = 0
-            startProgressBar("Retrieving and preparing data [layer %s]" % self.name(), xTiles * yTiles)
-            for x in xrange(xTiles):
-                for y in xrange(yTiles):
-                    minX = extent.xMinimum() + x * layer.rasterUnitsPerPixelX() * self.TILESIZE
-                    maxX = min(extent.xMaximum(), extent.xMinimum() + (x + 1) * layer.rasterUnitsPerPixelX() * self.TILESIZE)
-                    minY = extent.yMinimum() + y * layer.rasterUnitsPerPixelY() * self.TILESIZE
-                    maxY = min(extent.yMaximum(), extent.yMinimum() + (y + 1) * layer.rasterUnitsPerPixelY() * self.TILESIZE)
+        layerExtent = layer.extent()
+        tiles = []
+        if _extent.intersects(layerExtent):
+            extent = _extent.intersect(layerExtent)
+            originX = layerExtent.xMinimum()
+            originY = layerExtent.yMaximum()
+            tileWidth = layer.rasterUnitsPerPixelX() * self.TILESIZE
+            tileHeight = layer.rasterUnitsPerPixelY() * self.TILESIZE
+            minCol = int(math.floor(_gridCoord((extent.xMinimum() - originX) / tileWidth)))
+            maxCol = int(math.ceil(_gridCoord((extent.xMaximum() - originX) / tileWidth)))
+            minRow = int(math.floor(_gridCoord((originY - extent.yMaximum()) / tileHeight)))
+            maxRow = int(math.ceil(_gridCoord((originY - extent.yMinimum()) / tileHeight)))
+            for x in xrange(minCol, maxCol):
+                for y in xrange(minRow, maxRow):
+                    minX = originX + x * tileWidth
+                    maxX = min(layerExtent.xMaximum(), originX + (x + 1) * tileWidth)
+                    maxY = originY - y * tileHeight
+                    minY = max(layerExtent.yMinimum(), originY - (y + 1) * tileHeight)
                     pt1 = QgsPoint(minX, minY)
                     pt2 = QgsPoint(maxX, maxY)
-                    tileExtent = QgsRectangle(pt1, pt2)
-                    filename = os.path.join(folder, "%i_%i.tif" % (x, y))
-                    self._save(filename, tileExtent)
-                    i += 1
-                    setProgressValue(i)
-            closeProgressBar()
-        return folder
-
-    def tilesCount(self, extent):
+                    tiles.append(((x, y), QgsRectangle(pt1, pt2)))
+        return tiles
+
+    def pixelExtent(self, pt):
+        '''Returns the extent of the pixel of the layer that contains the passed point,
+        or None if the point is outside of the layer'''
         layer = self.layer()
-        xSize = extent.width() / layer.rasterUnitsPerPixelX()
-        ySize = extent.height() / layer.rasterUnitsPerPixelY()
-        xTiles = math.ceil(xSize / self.TILESIZE)
-        yTiles = math.ceil(ySize / self.TILESIZE)
-        return xTiles * yTiles
+        extent = layer.extent()
+        if not (extent.xMinimum() <= pt.x() < extent.xMaximum() and extent.yMinimum() < pt.y() <= extent.yMaximum()):
+            return None
+        pixelWidth = layer.rasterUnitsPerPixelX()
+        pixelHeight = layer.rasterUnitsPerPixelY()
+        col = int(math.floor(_gridCoord((pt.x() - extent.xMinimum()) / pixelWidth)))
+        row = int(math.floor(_gridCoord((extent.yMaximum() - pt.y()) / pixelHeight)))
+        pt1 = QgsPoint(extent.xMinimum() + col * pixelWidth, extent.yMaximum() - (row + 1) * pixelHeight)
+        pt2 = QgsPoint(extent.xMinimum() + (col + 1) * pixelWidth, extent.yMaximum() - row * pixelHeight)
+        return QgsRectangle(pt1, pt2)
+
+    def windowReader(self, extent, crs=None):
+        '''
+        Returns a (function, args) tuple to read all the bands of a single pixel, given its
+        extent and the authority id of its CRS. The function returns a (bands, 1, 1) array,
+        and it only uses the objects it receives, so it can be called from any thread.
+        By default, the data is written to a file through the provider of the layer
+        '''
+        return _readWithProvider, self._writeArgs(tempFilename("tif"), extent)
+
+def _gridCoord(v):
+    '''Rounds values that are only off from an integer due to floating point errors'''
+    return round(v) if abs(v - round(v)) < 1e-6 else v
+
+MAX_RETRIES = 3
+RETRY_DELAY = 1
+
+def _retry(function, exceptions, description):
+    '''
+    Calls a function until it doesn't raise any of the passed exceptions, retrying up to
+    MAX_RETRIES times, waiting RETRY_DELAY seconds before the first retry and doubling
+    the wait after each one. Failures are logged with the passed description of the
+    data being retrieved. Returns the result of the function, or raises IOError if
+    all the calls fail
+    '''
+    for attempt in xrange(MAX_RETRIES + 1):
+        if attempt:
+            delay = RETRY_DELAY * 2 ** (attempt - 1)
+            logger.warning("Could not retrieve %s. Retrying in %s seconds" % (description, delay))
+            timelib.sleep(delay)
+        try:
+            return function()
+        except exceptions, e:
+            logger.warning("Request for %s failed: %s" % (description, e))
+    raise IOError("Could not retrieve data for %s" % description)
+
+def _readFile(filename):
+    try:
+        return datasets.readBands(filename)
+    finally:
+        datasets.close([filename])
+        try:
+            os.remove(filename)
+        except OSError:
+            pass
+
+def _readWithProvider(filename, provider, xSize, ySize, extent, crs):
+    writeRaster(filename, provider, xSize, ySize, extent, crs)
+    return _readFile(filename)
+
+def _readWCS(service, coverageName, time, extent, crs, format):
+    '''Requests all the bands of an extent of a coverage with a single WCS GetCoverage
+    request, without creating a QGIS provider. Failed requests are retried with _retry'''
+    filename = tempFilename("tif")
+    bbox = (extent.xMinimum(), extent.yMinimum(), extent.xMaximum(), extent.yMaximum())
+    def read():
+        response = service.getCoverage(identifier=coverageName, bbox=bbox, time=[time], format=format,
+                                       crs=crs, width=1, height=1)
+        with open(filename, "wb") as f:
+            f.write(response.read())
+        return _readFile(filename)
+    '''HTTP and socket errors are EnvironmentErrors, and GDAL raises RuntimeError
+    if it has exceptions enabled'''
+    return _retry(read, (EnvironmentError, RuntimeError, ServiceException),
+                  "coverage %s at %s" % (coverageName, time))
+
+def extractPoint(layers, pt):
+    '''
+    Returns the values of all the bands of a list of layers of the same coverage at a
+    point, as a (time, band) float array, with a row for each layer, in the same order.
+
+    The pixel that contains the point is taken from the grid of the first layer, and all
+    its bands are retrieved with a single request per layer, running several of them at
+    the same time, as retrieveTiles does. Rows of layers whose data cannot be retrieved,
+    and all of them if the point is outside of the first layer, are NaN.
+
+    Retrieved values are kept in the cache of plot values, and only the layers that
+    are not in it are requested
+    '''
+    result = np.full((len(layers), len(layers[0].bands()) if layers else 0), np.nan)
+    extent = layers[0].pixelExtent(pt) if layers else None
+    if extent is None:
+        return result
+    cache = valuesCache()
+    keys = [lay.valuesKey(extent) for lay in layers]
+    missing = []
+    for i, key in enumerate(keys):
+        values = cache.get(key)
+        if values is None:
+            missing.append(i)
+        else:
+            result[i, :values.shape[0]] = values
+    if not missing:
+        return result
+    crs = layers[0].layer().crs().authid()
+    readers = [layers[i].windowReader(extent, crs) for i in missing]
+    pool = ThreadPool(max(1, int(pluginSetting("maxConcurrentRequests"))))
+    try:
+        pending = [pool.apply_async(function, args) for function, args in readers]
+        for i, request in zip(missing, pending):
+            try:
+                values = request.get()
+                result[i, :values.shape[0]] = values[:, 0, 0]
+                cache.put(keys[i], result[i].copy())
+            except (IOError, RuntimeError), e:
+                logger.warning("Could not retrieve %s: %s" % (layers[i].name(), e))
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+    return result
+
+def writeRaster(filename, provider, xSize, ySize, extent, crs):
+    '''
+    Writes the data of a provider within the given extent to a file. Failed requests
+    are retried up to MAX_RETRIES times, waiting RETRY_DELAY seconds before the first
+    retry and doubling the wait after each one.
+
+    It only uses the objects that it receives, so it can be called from any thread
+    '''
+    def write():
+        filewriter = QgsRasterFileWriter(filename)
+        pipe = QgsRasterPipe()
+        pipe.set(provider.clone())
+        error = filewriter.writeRaster(pipe, xSize, ySize, extent, crs)
+        if error != QgsRasterFileWriter.NoError:
+            raise IOError("Raster writer error %s" % error)
+        return filename
+    return _retry(write, IOError, "file %s" % filename)
+
+def retrieveTiles(jobs, isRetrieved=None, maxSize=None):
+    '''
+    Saves a list of tiles, each of them defined by a (layer, folder, tile) tuple, running
+    several requests at the same time. The maximum number of concurrent requests is set
+    in the plugin settings. Tiles whose file name makes isRetrieved return True are
+    considered already saved, and are not requested. If maxSize is passed, tiles are
+    downsampled to that maximum width and height, and they are not cached.
+
+    Yields the name of the file of each tile, in the same order as the list of tiles.
+    Requests are created and their results returned in the calling thread, so progress
+    can be safely reported while iterating
+    '''
+    maxRequests = max(1, int(pluginSetting("maxConcurrentRequests")))
+    pool = ThreadPool(maxRequests)
+    cache = tileCache()
+    pending = deque()
+    def _finished():
+        result, filename, key = pending.popleft()
+        if result is not None:
+            result.get()
+            if key is not None:
+                cache.put(key, filename)
+        return filename
+    try:
+        for layer, folder, tile in jobs:
+            (x, y), tileExtent = tile
+            filename = os.path.join(folder, "%i_%i.tif" % (x, y))
+            key = layer.cacheKey(tileExtent, (x, y)) if maxSize is None else None
+            if isRetrieved is not None and isRetrieved(filename):
+                pending.append((None, filename, None))
+            elif key is not None and cache.get(key, filename):
+                pending.append((None, filename, key))
+            else:
+                pending.append((pool.apply_async(writeRaster, layer._writeArgs(filename, tileExtent, maxSize)), filename, key))
+            while pending and (len(pending) > 2 * maxRequests or pending[0][0] is None or pending[0][0].ready()):
+                yield _finished()
+        while pending:
+            yield _finished()
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+    stats = cache.stats()
+    logger.info("Tile cache: %i hits, %i misses, %i tiles (%i bytes) stored" %
+                (stats["hits"], stats["misses"], stats["count"], stats["size"]))
 
 class WCSConnector():
 
@@ -111,6 +334,9 @@ class WCSCoverage():
         self._timepositions = {s.replace("Z", ""): s for s in coverage.timepositions}
         self.bands = coverage.axisDescriptions[0].values
         self.crs = coverage.supportedCRS[0]
+        formats = [f for f in coverage.supportedFormats if "tif" in f.lower()]
+        self.format = (formats or coverage.supportedFormats)[0]
+        self.qaRule = None
 
     def name(self):
         return self.coverageName
@@ -155,6 +381,18 @@ class WCSLayer(Layer):
             self._layer = QgsRasterLayer(self.source(), self.name(), "wcs")
         return self._layer
 
+    def windowReader(self, extent, crs=None):
+        return _readWCS, (self.coverage.service, self.coverage.name(), self._timeUnmodified, extent,
+                          crs or self.coverage.crs.getcode(), self.coverage.format)
+
+    def cacheKey(self, extent=None, tileIndex=None):
+        if tileIndex is not None:
+            tile = "%i/%i/%i" % ((self.TILESIZE,) + tuple(tileIndex))
+        else:
+            extent = extent or self.layer().extent()
+            tile = "%r,%r,%r,%r" % (extent.xMinimum(), extent.yMinimum(), extent.xMaximum(), extent.yMaximum())
+        return (self.coverage.url, self.coverage.name(), self._time, tile)
+
 
 class FileConnector():
 
@@ -186,7 +424,15 @@ class FileCoverage():
         self.folder = folder
         self._timepositions = []
         with open(os.path.join(folder, 'bands.json')) as f:
-            self.bands = json.load(f)
+            description = json.load(f)
+        '''bands.json can contain just the list of bands, or an object with the list
+        of bands and the rule to use for masking pixels based on the QA band'''
+        if isinstance(description, dict):
+            self.bands = description["bands"]
+            self.qaRule = description.get("qa")
+        else:
+            self.bands = description
+            self.qaRule = None
         self._exts = {}
         for f in os.listdir(folder):
             path = os.path.join(folder, f)
@@ -238,5 +484,18 @@ class FileLayer(Layer):
     def layer(self):
         return QgsRasterLayer(self.source(), self.name(), "gdal")
 
+    def windowReader(self, extent, crs=None):
+        return _readFileWindow, (self.source(), extent)
+
+def _readFileWindow(filename, extent):
+    '''Reads the bands of an extent aligned with the pixels of a file directly with GDAL'''
+    ds = datasets.dataset(filename)
+    x0, pixelWidth, _, y1, _, pixelHeight = ds.GetGeoTransform()
+    col = int(round((extent.xMinimum() - x0) / pixelWidth))
+    row = int(round((extent.yMaximum() - y1) / pixelHeight))
+    width = max(1, int(round(extent.width() / pixelWidth)))
+    height = max(1, int(round(extent.height() / abs(pixelHeight))))
+    return datasets.readBands(filename, window=(col, row, width, height))
+
 
 connectors = [WCSConnector, FileConnector]
\ No newline at end of file
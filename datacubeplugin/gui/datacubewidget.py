@@ -24,7 +24,7 @@ from datacubeplugin.gui.plotwidget import plotWidget
 from datacubeplugin.gui.mosaicwidget import mosaicWidget
 from datacubeplugin.gui.downloaddialog import DownloadDialog
 from datacubeplugin import plotparams
-from datacubeplugin.utils import addLayerIntoGroup, dateFromDays, daysFromDate, setLayerRGB
+from datacubeplugin.utils import addLayerIntoGroup, dateFromDays, daysFromDate, setLayerRGB, qaMaskForCoverage
 import datetime
 
 pluginPath = os.path.dirname(os.path.dirname(__file__))
@@ -87,8 +87,8 @@ class DataCubeWidget(BASE, WIDGET):
     def coverageToPlotHasChanged(self):
         txt = self.comboCoverageToPlot.currentText()
         name, coverageName = txt.split(" : ")
-        bands = layers._coverages[name][coverageName].bands
-        self.plotParameters = plotparams.getParameters(bands)
+        coverage = layers._coverages[name][coverageName]
+        self.plotParameters = plotparams.getParameters(coverage.bands, qaMaskForCoverage(coverage))
         self.comboParameterToPlot.blockSignals(True)
         self.comboParameterToPlot.clear()
         self.comboParameterToPlot.addItems([str(p) for p in self.plotParameters])
@@ -328,7 +328,10 @@ class CoverageItem(TreeItemWithLink):
                     
             bandsFile = os.path.join(folder, "bands.json")
             with open(bandsFile, "w") as f:
-                json.dump(self.coverage.bands, f) 
+                if self.coverage.qaRule:
+                    json.dump({"bands": self.coverage.bands, "qa": self.coverage.qaRule}, f)
+                else:
+                    json.dump(self.coverage.bands, f)
             startProgressBar("Downloading datacube subset", len(timepositions))
             for i, time in enumerate(timepositions):
                 setProgressValue(i)
@@ -1,24 +1,25 @@
 import os
-import numpy as np
 from qgis.core import *
 from qgis.gui import QgsMessageBar
 from qgis.utils import iface
 from qgis.PyQt import uic
 from datacubeplugin import layers
 from qgiscommons2.layers import layerFromSource, WrongLayerSourceException
-from qgiscommons2.files import tempFilename, tempFolderInTempFolder
 from dateutil import parser
-from osgeo import gdal
-from osgeo.gdalconst import GA_ReadOnly
 from datacubeplugin.gui.selectextentmaptool import SelectExtentMapTool
-from datacubeplugin.mosaicfunctions import mosaicFunctions, NO_DATA
-from datacubeplugin.utils import addLayerIntoGroup, dateFromDays, daysFromDate
-from datacubeplugin.layers import getArray
+from datacubeplugin.mosaicfunctions import mosaicFunctions, TemporalStatistics
+from datacubeplugin.utils import (addLayerIntoGroup, rgbBands, dateFromDays, daysFromDate, qaMaskForCoverage,
+                                  groupByPeriod, PERIODS)
+from datacubeplugin.mosaic import TilePipeline, MosaicWriter, workersCount, processTile, processTilePeriods
+from datacubeplugin.connectors import retrieveTiles
+from datacubeplugin.jobs import MosaicJob, findBaseJob, evictJobs, jobsFolder
 from qgiscommons2.gui import execute, startProgressBar, closeProgressBar, setProgressValue
+from qgiscommons2.settings import pluginSetting
+from osgeo import gdal
 import processing
 import time as timelib
+import shutil
 import logging
-import math
 
 logger = logging.getLogger('datacube')
 
@@ -26,6 +27,11 @@ pluginPath = os.path.dirname(os.path.dirname(__file__))
 WIDGET, BASE = uic.loadUiType(
     os.path.join(pluginPath, 'ui', 'mosaicwidget.ui'))
 
+def _mosaicExtent(tiles):
+    '''Returns the extent covered by a list of (index, extent) tiles'''
+    return QgsRectangle(min(t.xMinimum() for _, t in tiles), min(t.yMinimum() for _, t in tiles),
+                        max(t.xMaximum() for _, t in tiles), max(t.yMaximum() for _, t in tiles))
+
 class MosaicWidget(BASE, WIDGET):
 
     def __init__(self, parent=None):
@@ -40,6 +46,9 @@ class MosaicWidget(BASE, WIDGET):
         self.mapTool = SelectExtentMapTool(iface.mapCanvas(), self)
         self.sliderStartDate.valueChanged.connect(self.startDateChanged)
         self.sliderEndDate.valueChanged.connect(self.endDateChanged)
+        self.comboPeriods.addItems(["Single mosaic", "Monthly", "Quarterly", "Yearly", "Custom periods"])
+        self.comboPeriods.currentIndexChanged.connect(self.periodsChanged)
+        self.periodsChanged()
 
         iface.mapCanvas().mapToolSet.connect(self.unsetTool)
 
@@ -49,6 +58,9 @@ class MosaicWidget(BASE, WIDGET):
     def endDateChanged(self):
         self.txtEndDate.setText(str(dateFromDays(self.sliderEndDate.value())).split(" ")[0])
 
+    def periodsChanged(self):
+        self.txtPeriodStarts.setEnabled(self.comboPeriods.currentIndex() == len(PERIODS))
+
     def useCanvasExtent(self):
         self.setExtent(iface.mapCanvas().extent())
 
@@ -107,6 +119,17 @@ class MosaicWidget(BASE, WIDGET):
 
     def _createMosaic(self):
         mosaicFunction = mosaicFunctions[self.comboMosaicType.currentIndex()]
+        if isinstance(mosaicFunction, TemporalStatistics):
+            setting = pluginSetting("statisticsPercentiles")
+            try:
+                percentiles = [float(p) for p in setting.split(",") if p.strip()]
+                if any(p < 0 or p > 100 for p in percentiles):
+                    raise ValueError()
+            except ValueError:
+                iface.messageBar().pushMessage("", "Wrong value for percentiles setting: %s" % setting,
+                                               level=QgsMessageBar.WARNING)
+                return
+            mosaicFunction.percentiles = percentiles
         def getValue(textbox, paramName):
             try:
                 v = float(textbox.text())
@@ -137,146 +160,370 @@ class MosaicWidget(BASE, WIDGET):
             if (time >= minDays and time <= maxDays):
                 validLayers.append(layer)
 
-        bandNames = layers._coverages[name][coverageName].bands
+        coverage = layers._coverages[name][coverageName]
+        bandNames = coverage.bands
+        qaMask = qaMaskForCoverage(coverage)
+        if not mosaicFunction.canBeComputed(bandNames):
+            iface.messageBar().pushMessage("", "%s mosaics cannot be computed with the bands of the selected coverage" % mosaicFunction.name,
+                                               level=QgsMessageBar.WARNING)
+            return
         if validLayers:
-            newBands = []
-            tilesFolders = []
-            dstFolder = tempFolderInTempFolder()
-
-            '''We download the layers so we can access them locally'''
-            lay = validLayers[0]
-            xSize = extent.width() / lay.layer().rasterUnitsPerPixelX()
-            ySize = extent.height() / lay.layer().rasterUnitsPerPixelY()
-            xTiles = math.ceil(xSize / lay.TILESIZE)
-            yTiles = math.ceil(ySize / lay.TILESIZE)
-            logger.info("Downloading datacube layers to local files. Extent:%sx%s. Tiles count: %sx%s" %
-                         (extent.width(), extent.height(),xTiles, yTiles))
-            for i, lay in enumerate(validLayers):
-                start = timelib.time()
-                tilesFolders.append(lay.saveTiles(extent))
-                end = timelib.time()
-                logger.info("Layer %s downloaded in %s seconds." % (str(i), str(end-start)))
-
             try:
                 qaBand = bandNames.index("pixel_qa")
             except:
                 qaBand = None
-            tileFiles = os.listdir(tilesFolders[0])
-            if not tileFiles:
+
+            tiles = validLayers[0].tiles(extent)
+            if not tiles:
                 iface.messageBar().pushMessage("", "No available data within the selected extent.",
                                                level=QgsMessageBar.WARNING)
                 return
-            startProgressBar("Processing mosaic data", len(tileFiles))
-            '''Now we process all tiles separately'''
-            for i, filename in enumerate(tileFiles):
-                tilestart = timelib.time()
-                setProgressValue(i)
-
-                start = timelib.time()
-                newBands = {}
-                files = [os.path.join(folder, filename) for folder in tilesFolders]
-                if qaBand is not None:
-                    qaData = [getArray(f, qaBand + 1) for f in files]
-                else:
-                    qaData = None
-
-                end = timelib.time()
-                logger.info("QA band prepared in %s seconds" % (str(end-start)))
-
-
-                if mosaicFunction.bandByBand:
-                    '''
-                    We operate band by band, since a given band in the the final result
-                    layer depends only on the values of that band in the input layers,
-                    not the value of other bands'''
-                    start = timelib.time()
-                    for band, bandName in enumerate(bandNames):
-                        if band == qaBand:
-                            newBands[bandName] = mosaicFunction.computeQAMask(qaData)
-                        else:
-                            bandData = [getArray(f, band + 1) for f in files]
-                            newBands[bandName] = mosaicFunction.compute(bandData, qaData)
-                            bandData = None
-                    end = timelib.time()
-                    logger.info("Tile %s read and processed in %s seconds." % (str(i), str(end-start)))
-                else:
-                    '''
-                    We operate with all bands at once, and the output layer will
-                    have only each band computed from the set of them in the input
-                    layers'''
-                    bandData = []
-                    bandNamesArray = []
-                    start = timelib.time()
-                    for i, band in enumerate(bandNames):
-                        if i != qaBand:
-                            bandData.append([getArray(f, i + 1) for f in files])
-                            bandNamesArray.append(band)
-                    end = timelib.time()
-                    logger.info("Tile %s data read and prepared in %s seconds." % (str(i), str(end-start)))
-                    start = timelib.time()
-                    newBandsArray = mosaicFunction.compute(bandData, qaData)
-                    end = timelib.time()
-                    logger.info("Tile %s data processed in %s seconds." % (str(i), str(end-start)))
-                    newBands = {k: v for k, v in zip(bandNamesArray, newBandsArray)}
-                    if qaBand is not None:
-                        start = timelib.time()
-                        newBands[bandNames[qaBand]] = mosaicFunction.computeQAMask(qaData)
-                        end = timelib.time()
-                        logger.info("QA band prepared in %s seconds" % (str(end-start)))
-                    bandData = None
-
-                start = timelib.time()
-                '''We write the set of bands as a new layer. That will be an output tile'''
-                templateFilename = os.path.join(tilesFolders[0], filename)
-                ds = gdal.Open(templateFilename, GA_ReadOnly)
-                bandCount = ds.RasterCount
-                datatype = ds.GetRasterBand(1).DataType
-                width = ds.RasterXSize
-                height = ds.RasterYSize
-                geotransform = ds.GetGeoTransform()
-                projection = ds.GetProjection()
-                del ds
-                driver = gdal.GetDriverByName("GTiff")
-                dstFilename = os.path.join(dstFolder, filename)
-                dstDs= driver.Create(dstFilename, width, height, bandCount, datatype)
-
-                for b, band in enumerate(bandNames):
-                    gdalBand = dstDs.GetRasterBand(b+1)
-                    gdalBand.SetNoDataValue(NO_DATA)
-                    gdalBand.WriteArray(newBands[band])
-                    gdalBand.FlushCache()
-                del newBands
-
-                dstDs.SetGeoTransform(geotransform)
-                dstDs.SetProjection(projection)
-
-                del dstDs
-
-                end = timelib.time()
-                logger.info("Tile %s written to local file in %s seconds." % (str(i), str(end-start)))
-
-                tileend = timelib.time()
-                logger.info("Total time to process tile: %s seconds." % (str(tileend-tilestart)))
-
-
-            '''With all the tiles, we create a virtual raster'''
-            toMerge = ";".join([os.path.join(dstFolder, f) for f in tileFiles])
-            outputFile = os.path.join(dstFolder, "mosaic.vrt")
-            processing.runalg("gdalogr:buildvirtualraster", {"INPUT":toMerge, "SEPARATE":False, "OUTPUT":outputFile})
-
-            layer = QgsRasterLayer(outputFile, "Mosaic [%s]" % mosaicFunction.name, "gdal")
-
-            layers._mosaicLayers[validLayers[0].datasetName()][validLayers[0].coverageName()].append(outputFile)
-
-            addLayerIntoGroup(layer, validLayers[0].datasetName(), validLayers[0].coverageName(), bandNames)
-
-            closeProgressBar()
-
-            iface.messageBar().pushMessage("", "Mosaic has been correctly created and added to project.",
+            logger.info("Creating mosaic. Extent:%sx%s. Tiles count: %s" %
+                         (extent.width(), extent.height(), len(tiles)))
+
+            outputFormat = pluginSetting("mosaicOutput")
+            memoryBudget = int(float(pluginSetting("mosaicMemoryBudget")) * 1024 * 1024)
+            '''The state of the job is stored in a manifest, so, if it is interrupted,
+            running it again with the same parameters resumes it where it was left.
+            Finished jobs are kept as a cache of results, so running a job with the
+            same parameters again returns its result without computing it'''
+            def createJob(jobLayers):
+                return MosaicJob({"dataset": validLayers[0].datasetName(), "coverage": coverageName,
+                                  "layers": [[lay.time(), lay.source()] for lay in jobLayers],
+                                  "tiles": [tileIndex for tileIndex, _ in tiles],
+                                  "function": [mosaicFunction.name, vars(mosaicFunction)], "bands": bandNames,
+                                  "qa": [qaMask.invalidValues, qaMask.invalidBits],
+                                  "output": outputFormat})
+            periodIndex = self.comboPeriods.currentIndex()
+            if periodIndex > 0:
+                period = PERIODS[periodIndex - 1]
+                starts = None
+                if period == "custom":
+                    try:
+                        starts = sorted(parser.parse(s) for s in self.txtPeriodStarts.text().split(",") if s.strip())
+                        if not starts:
+                            raise ValueError()
+                    except ValueError:
+                        iface.messageBar().pushMessage("", "Wrong value for start dates of periods: %s" % self.txtPeriodStarts.text(),
+                                                       level=QgsMessageBar.WARNING)
+                        return
+                periods = groupByPeriod([parser.parse(lay.time()) for lay in validLayers], period, starts)
+                if not periods:
+                    iface.messageBar().pushMessage("", "No layers available within the selected periods.",
+                                                   level=QgsMessageBar.WARNING)
+                    return
+                periodJobs = [(name, first, last, createJob(validLayers[first:last])) for name, first, last in periods]
+                self._computePeriodMosaics(periodJobs, mosaicFunction, validLayers, tiles, bandNames, qaBand, qaMask,
+                                           memoryBudget)
+                return
+            job = createJob(validLayers)
+            outputFile = job.finishedOutput()
+            if outputFile is not None:
+                logger.info("Mosaic job %s was already finished" % job.id)
+                job.touch()
+                self._addMosaicLayer(outputFile, mosaicFunction, validLayers[0], bandNames, qaBand)
+                iface.messageBar().pushMessage("", "Mosaic had already been created and has been added to project.",
                                                level=QgsMessageBar.INFO)
+                return
+            args = (job, mosaicFunction, validLayers, tiles, bandNames, qaBand, qaMask, memoryBudget)
+            previewLayer = self._createPreview(*args)
+            if previewLayer is None:
+                self._computeMosaic(*args)
+            else:
+                '''The full resolution mosaic is computed, in the GUI thread as the rest
+                of the mosaic, once the canvas has been rendered with the preview, so
+                it can be checked while waiting for the full resolution one. If the
+                canvas is not rendering, it would never be refreshed, so the mosaic is
+                computed right away'''
+                canvas = iface.mapCanvas()
+                if not canvas.renderFlag() or canvas.isFrozen():
+                    self._computeMosaic(*args, previewLayer=previewLayer)
+                    return
+                def computeMosaic():
+                    canvas.mapCanvasRefreshed.disconnect(computeMosaic)
+                    execute(lambda: self._computeMosaic(*args, previewLayer=previewLayer))
+                canvas.mapCanvasRefreshed.connect(computeMosaic)
+                canvas.refresh()
         else:
             iface.messageBar().pushMessage("", "No layers available from the selected coverage.",
                                                level=QgsMessageBar.WARNING)
 
+    def _createPreview(self, job, mosaicFunction, validLayers, tiles, bandNames, qaBand, qaMask, memoryBudget):
+        '''
+        Computes the mosaic at a coarse resolution, with a single request per layer for
+        the whole extent of the mosaic, and adds it to the project. Returns the id of the
+        added layer, or None if no preview is needed
+        '''
+        previewSize = int(pluginSetting("mosaicPreviewSize"))
+        mosaicExtent = _mosaicExtent(tiles)
+        layer = validLayers[0].layer()
+        if previewSize <= 0 or max(mosaicExtent.width() / layer.rasterUnitsPerPixelX(),
+                                   mosaicExtent.height() / layer.rasterUnitsPerPixelY()) <= previewSize:
+            return None
+        start = timelib.time()
+        folders = [job.subfolder("preview", str(i)) for i in xrange(len(validLayers))]
+        jobs = [(lay, folder, ((0, 0), mosaicExtent)) for lay, folder in zip(validLayers, folders)]
+        startProgressBar("Creating mosaic preview", len(jobs) + 1)
+        try:
+            files = []
+            for filename in retrieveTiles(jobs, maxSize=previewSize):
+                files.append(filename)
+                setProgressValue(len(files))
+            outputFile = processTile(mosaicFunction, files, bandNames, qaBand, qaMask,
+                                     os.path.join(job.subfolder("preview"), "preview.tif"), memoryBudget)
+        finally:
+            closeProgressBar()
+        logger.info("Mosaic preview created in %s seconds." % str(timelib.time() - start))
+        layer = self._addMosaicLayer(outputFile, mosaicFunction, validLayers[0], bandNames, qaBand,
+                                     "Mosaic [%s] (preview)" % mosaicFunction.name)
+        return layer.id()
+
+    def _computeMosaic(self, job, mosaicFunction, validLayers, tiles, bandNames, qaBand, qaMask, memoryBudget,
+                       previewLayer=None):
+        '''
+        Computes the mosaic at full resolution and adds it to the project, replacing
+        the preview layer, if its id is passed
+        '''
+        if job.isResumed():
+            logger.info("Resuming mosaic job %s" % job.id)
+        dstFolder = job.subfolder("tiles")
+
+        '''For streaming functions, the state of each tile is stored, so the mosaic
+        can be updated later with new layers. If there is a mosaic of the first
+        layers that stored it, only the rest of layers have to be retrieved and
+        folded into that state'''
+        inputLayers = validLayers
+        statesFolder = None
+        baseStatesFolder = None
+        if mosaicFunction.streaming:
+            statesFolder = job.subfolder("states")
+            baseJob = findBaseJob(job.parameters)
+            if baseJob is not None:
+                baseStatesFolder = os.path.join(baseJob.folder, "states")
+                if all(os.path.exists(os.path.join(baseStatesFolder, "%i_%i.npz" % tile[0])) for tile in tiles):
+                    baseJob.touch()
+                    inputLayers = validLayers[len(baseJob.parameters["layers"]):]
+                    logger.info("Updating mosaic job %s with %i new layers" % (baseJob.id, len(inputLayers)))
+                else:
+                    baseStatesFolder = None
+        def tileTask(files, dstFilenames):
+            name = os.path.splitext(os.path.basename(files[0]))[0]
+            stateFilename = baseStateFilename = None
+            if statesFolder is not None:
+                stateFilename = os.path.join(statesFolder, name + ".npz")
+            if baseStatesFolder is not None:
+                baseStateFilename = os.path.join(baseStatesFolder, name + ".npz")
+            return (mosaicFunction, files, bandNames, qaBand, qaMask, dstFilenames[0],
+                    memoryBudget, stateFilename, baseStateFilename)
+
+        firstLayer = len(validLayers) - len(inputLayers)
+        tilesFolders = [job.subfolder("inputs", str(firstLayer + i)) for i in xrange(len(inputLayers))]
+        start = timelib.time()
+        writers, tileFiles = self._processTiles("Creating mosaic", tiles, inputLayers, tilesFolders, job,
+                                                [job], [dstFolder], tileTask)
+        end = timelib.time()
+        logger.info("%i tiles downloaded and processed in %s seconds." % (len(tileFiles), str(end-start)))
+
+        '''The preview is removed before finishing the job, which deletes its file'''
+        if previewLayer in QgsMapLayerRegistry.instance().mapLayers():
+            QgsMapLayerRegistry.instance().removeMapLayer(previewLayer)
+
+        outputFile = self._finishJob(job, writers[0], dstFolder, tileFiles, [statesFolder])
+
+        self._addMosaicLayer(outputFile, mosaicFunction, validLayers[0], bandNames, qaBand)
+
+        closeProgressBar()
+
+        self._evictMosaics()
+
+        iface.messageBar().pushMessage("", "Mosaic has been correctly created and added to project.",
+                                           level=QgsMessageBar.INFO)
+
+    def _computePeriodMosaics(self, periodJobs, mosaicFunction, validLayers, tiles, bandNames, qaBand, qaMask,
+                              memoryBudget):
+        '''
+        Computes a mosaic for each one of several periods, given a list of (name, first,
+        last, job) tuples, with the name of each period, the range of its layers and
+        the job that computes its mosaic. Jobs that were already finished are reused.
+        For the rest, layers are retrieved only once, and the data of each tile is read
+        once to compute the mosaics of all the periods
+        '''
+        pending = [p for p in periodJobs if p[3].finishedOutput() is None]
+        for name, first, last, job in periodJobs:
+            if job.finishedOutput() is not None:
+                logger.info("Mosaic job %s for period %s was already finished" % (job.id, name))
+                job.touch()
+        if pending:
+            layerIndices = [i for _, first, last, _ in pending for i in xrange(first, last)]
+            inputLayers = [validLayers[i] for i in layerIndices]
+            ranges = []
+            for _, first, last, _ in pending:
+                start = ranges[-1][1] if ranges else 0
+                ranges.append((start, start + last - first))
+            jobs = [job for _, _, _, job in pending]
+            '''Input tiles are shared by all periods, so they are recorded in a job of
+            their own, which is removed once all the mosaics are finished'''
+            inputsJob = MosaicJob({"periods": [job.id for job in jobs]})
+            if inputsJob.isResumed():
+                logger.info("Resuming mosaics for %i periods" % len(jobs))
+            tilesFolders = [inputsJob.subfolder("inputs", str(i)) for i in layerIndices]
+            dstFolders = [job.subfolder("tiles") for job in jobs]
+            def tileTask(files, dstFilenames):
+                return (mosaicFunction, files, ranges, bandNames, qaBand, qaMask, dstFilenames, memoryBudget)
+            start = timelib.time()
+            writers, tileFiles = self._processTiles("Creating mosaics for %i periods" % len(jobs), tiles,
+                                                    inputLayers, tilesFolders, inputsJob, jobs, dstFolders,
+                                                    tileTask, processTilePeriods)
+            end = timelib.time()
+            logger.info("%i tiles downloaded and processed for %i periods in %s seconds." %
+                        (len(tileFiles), len(jobs), str(end-start)))
+            for job, writer, dstFolder in zip(jobs, writers, dstFolders):
+                self._finishJob(job, writer, dstFolder, tileFiles)
+            shutil.rmtree(inputsJob.folder, ignore_errors=True)
+            closeProgressBar()
+
+        for name, first, last, job in periodJobs:
+            self._addMosaicLayer(job.finishedOutput(), mosaicFunction, validLayers[first], bandNames, qaBand,
+                                 "Mosaic [%s] %s" % (mosaicFunction.name, name))
+
+        self._evictMosaics()
+
+        iface.messageBar().pushMessage("", "Mosaics for %i periods have been correctly created and added to project." % len(periodJobs),
+                                           level=QgsMessageBar.INFO)
+
+    def _processTiles(self, title, tiles, inputLayers, tilesFolders, inputsJob, jobs, dstFolders, tileTask,
+                      function=processTile):
+        '''
+        Computes the tiles of one or several mosaics from the same input layers, given
+        the jobs of the mosaics and the folders for their output tiles. Input tiles are
+        retrieved into tilesFolders, one for each layer, and recorded in inputsJob.
+
+        We download the layers tile by tile, so we can access them locally. Several
+        requests are run at the same time and, once a tile is available for all the
+        layers, it is processed in the background while the next ones are downloaded.
+        Tiles are independent, so they can be processed in parallel. Tiles that are
+        done for all the jobs are not retrieved again.
+
+        tileTask receives the input files of a tile and the output files of the tile for
+        each job, and returns the arguments of function, which returns the output file,
+        or a list with the output files for all jobs.
+
+        Returns the writers of the jobs and the names of the tile files. The progress
+        bar is left open, so the caller can finish the jobs
+        '''
+        '''Unless a VRT is used, computed tiles are added to a single GeoTIFF
+        file as soon as they are finished. Tiles are kept until the job is finished,
+        so the GeoTIFF file can be recreated if the job is resumed'''
+        mosaicExtent = _mosaicExtent(tiles)
+        extent = (mosaicExtent.xMinimum(), mosaicExtent.yMinimum(), mosaicExtent.xMaximum(), mosaicExtent.yMaximum())
+        writers = [None if job.parameters["output"] == "VRT" else
+                   MosaicWriter(os.path.join(job.folder, "mosaic.tif"), extent, inputLayers[0].TILESIZE)
+                   for job in jobs]
+        def tileFinished(dstFilenames, record=True):
+            for job, writer, dstFilename in zip(jobs, writers, dstFilenames):
+                if record:
+                    job.setOutputDone(dstFilename)
+                if writer is not None:
+                    writer.write(dstFilename)
+        pipeline = TilePipeline(workersCount(pluginSetting("mosaicWorkers")), function=function)
+        startProgressBar(title, len(tiles) * (len(inputLayers) + 1))
+        progress = 0
+        tileFiles = []
+        retrievalJobs = []
+        try:
+            for tile in tiles:
+                filename = "%i_%i.tif" % tile[0]
+                tileFiles.append(filename)
+                dstFilenames = [os.path.join(folder, filename) for folder in dstFolders]
+                if all(job.isOutputDone(f) for job, f in zip(jobs, dstFilenames)):
+                    tileFinished(dstFilenames, record=False)
+                    progress += len(inputLayers) + 1
+                else:
+                    retrievalJobs.extend([(lay, folder, tile) for lay, folder in zip(inputLayers, tilesFolders)])
+            setProgressValue(progress)
+            files = []
+            for filename in retrieveTiles(retrievalJobs, inputsJob.isInputDone):
+                inputsJob.setInputDone(filename)
+                files.append(filename)
+                progress += 1
+                if len(files) == len(inputLayers):
+                    dstFilenames = [os.path.join(folder, os.path.basename(files[0])) for folder in dstFolders]
+                    for finished in pipeline.submit(tileTask(files, dstFilenames)):
+                        tileFinished(finished if isinstance(finished, list) else [finished])
+                        progress += 1
+                    files = []
+                setProgressValue(progress)
+            for finished in pipeline.finish():
+                tileFinished(finished if isinstance(finished, list) else [finished])
+                progress += 1
+                setProgressValue(progress)
+        except:
+            inputsJob.save(force=True)
+            for job, writer in zip(jobs, writers):
+                job.save(force=True)
+                if writer is not None:
+                    writer.close(overviews=False)
+            pipeline.terminate()
+            closeProgressBar()
+            raise
+        return writers, tileFiles
+
+    def _finishJob(self, job, writer, dstFolder, tileFiles, keep=None):
+        '''Closes the output file of a job, or creates a virtual raster of its tiles if it
+        has no writer, and finishes the job, keeping only that file and the folders in
+        the keep list. Returns the name of the output file'''
+        keep = list(keep or [])
+        if writer is None:
+            '''With all the tiles, we create a virtual raster. It is faster to create,
+            but slower to render, since it has no overviews'''
+            outputFile = os.path.join(job.folder, "mosaic.vrt")
+            self._buildVirtualRaster(outputFile, [os.path.join(dstFolder, f) for f in tileFiles])
+            keep.append(dstFolder)
+        else:
+            outputFile = writer.close()
+        job.finish(outputFile, keep=keep)
+        return outputFile
+
+    def _addMosaicLayer(self, outputFile, mosaicFunction, sourceLayer, bandNames, qaBand, layerName=None):
+        layer = QgsRasterLayer(outputFile, layerName or "Mosaic [%s]" % mosaicFunction.name, "gdal")
+        outputNames = mosaicFunction.outputBandNames(bandNames, qaBand)
+        if outputNames == bandNames:
+            layers._mosaicLayers[sourceLayer.datasetName()][sourceLayer.coverageName()].append(outputFile)
+            addLayerIntoGroup(layer, sourceLayer.datasetName(), sourceLayer.coverageName(), bandNames)
+        else:
+            '''Each band has several output bands, or none. The first one of each band is used to
+            render the layer with the same RGB bands as the coverage. The layer is not
+            updated when those bands change, since its bands are not the ones of the coverage'''
+            offsets = [len(mosaicFunction.outputBandNames(bandNames[:i], qaBand)) for i in xrange(len(bandNames))]
+            rgb = rgbBands(sourceLayer.datasetName(), sourceLayer.coverageName(), bandNames)
+            '''Bands with no output bands of their own are rendered with the first output band'''
+            rgb = [offsets[i] if mosaicFunction.outputBands(bandNames[i]) else 0 for i in rgb]
+            addLayerIntoGroup(layer, sourceLayer.datasetName(), sourceLayer.coverageName(), outputNames,
+                              rgb=rgb)
+        return layer
+
+    def _evictMosaics(self):
+        '''Removes the least recently used mosaics if they take more than the size set
+        in the plugin settings. Mosaics loaded in the project are kept'''
+        maxSize = int(float(pluginSetting("mosaicCacheSize")) * 1024 * 1024)
+        if maxSize <= 0:
+            return
+        folder = jobsFolder()
+        keep = []
+        for layer in QgsMapLayerRegistry.instance().mapLayers().values():
+            source = os.path.abspath(layer.source())
+            if source.startswith(os.path.abspath(folder)):
+                keep.append(os.path.join(folder, os.path.relpath(source, folder).split(os.sep)[0]))
+        removed = evictJobs(maxSize, keep)
+        if removed:
+            logger.info("%i mosaics removed from the mosaic cache" % removed)
+
+    def _buildVirtualRaster(self, outputFile, files):
+        if hasattr(gdal, "BuildVRT"):
+            vrt = gdal.BuildVRT(outputFile, files)
+            vrt = None
+        else:
+            processing.runalg("gdalogr:buildvirtualraster", {"INPUT":";".join(files), "SEPARATE":False, "OUTPUT":outputFile})
+
 mosaicWidget = MosaicWidget(iface.mainWindow())
 
@@ -1,4 +1,5 @@
 import os
+import numpy as np
 from qgis.core import *
 from qgis.utils import iface
 from qgis.PyQt import uic
@@ -12,6 +13,8 @@ from matplotlib.figure import Figure
 from matplotlib import axes
 from datacubeplugin import plotparams
 from datacubeplugin import layers
+from datacubeplugin.connectors import extractPoint
+from datacubeplugin.cache import valuesCache
 from qgiscommons2.layers import layerFromSource, WrongLayerSourceException
 from qgiscommons2.gui import askForFiles, execute, startProgressBar, closeProgressBar, setProgressValue
 from dateutil import parser
@@ -114,19 +117,30 @@ class PlotWidget(BASE, WIDGET):
 
             if self.rectangle is None:
                 self.data = {}
-                startProgressBar("Retrieving plot data", len(canvasLayers))
-                for (i, (layerdef, time)) in enumerate(canvasLayers):
-                    if ((minDate is not None and time < minDate) or
-                        (maxDate is not None and time > maxDate)):
-                        continue
-                    start = timelib.time()
-                    layer = layerdef.layer()
-                    v = self.parameter.value(layer, self.pt, bands)
-                    end = timelib.time()
-                    logger.info("Plot data for layer %i retrieved in %s seconds" % (i, str(end-start)))
-                    setProgressValue(i + 1)
-                    if v is not None:
-                        self.data[time] = [(v, (self.pt.x(), self.pt.y()))]
+                '''All the bands of the pixel are retrieved at once for each date, with
+                several dates retrieved at the same time, and the parameter is computed
+                for all dates from the resulting (time, band) array'''
+                pointLayers = [(layerdef, time) for layerdef, time in canvasLayers
+                               if not ((minDate is not None and time < minDate) or
+                                       (maxDate is not None and time > maxDate))]
+                startProgressBar("Retrieving plot data", 1)
+                if not pointLayers:
+                    closeProgressBar()
+                    return
+                start = timelib.time()
+                values = extractPoint([layerdef for layerdef, time in pointLayers], self.pt)
+                end = timelib.time()
+                logger.info("Plot data for %i layers retrieved in %s seconds" % (len(pointLayers), str(end-start)))
+                setProgressValue(1)
+                try:
+                    v = self.parameter.maskedArray(list(values.T), bands)
+                except NotImplementedError:
+                    v = [None if np.isnan(row).any() else
+                         self.parameter.value([np.array([[b]]) for b in row], QgsPoint(0, 0), bands) for row in values]
+                    v = np.array([np.nan if x is None else x for x in v])
+                for (layerdef, time), value in zip(pointLayers, v):
+                    if not np.isnan(value):
+                        self.data[time] = [(float(value), (self.pt.x(), self.pt.y()))]
                 closeProgressBar()
                 if not self.data:
                     return
@@ -147,21 +161,39 @@ class PlotWidget(BASE, WIDGET):
                     rectangle = self.rectangle.intersect(layer.extent())
                     xsteps = int(rectangle.width() / layer.rasterUnitsPerPixelX())
                     ysteps = int(rectangle.height() / layer.rasterUnitsPerPixelY())
-                    filename = layerdef.layerFile(rectangle)
-                    roi = layers.getBandArrays(filename)
+                    '''Band values are kept in a cache, so plotting another parameter or
+                    range of dates for the same region doesn't retrieve them again'''
+                    key = layerdef.valuesKey(rectangle)
+                    roi = valuesCache().get(key)
+                    if roi is None:
+                        filename = layerdef.layerFile(rectangle)
+                        roi = layers.getBandArrays(filename)
+                        valuesCache().put(key, roi)
                     end = timelib.time()
                     logger.info("ROI data for layer %i retrieved in %s seconds" % (i, str(end-start)))
                     start = timelib.time()
                     setProgressValue(i + 1)
-                    self.data[time] = []
-                    for col in range(xsteps):
-                        x = rectangle.xMinimum() + col * layer.rasterUnitsPerPixelX()
-                        for row in range(ysteps):
-                            y = rectangle.yMinimum() + row * layer.rasterUnitsPerPixelY()
-                            pixel = QgsPoint(col, row)
-                            value = self.parameter.value(roi, pixel, bands)
-                            if value:
-                                self.data[time].append((value, (x, y)))
+                    try:
+                        values = self.parameter.maskedArray(roi, bands)[:ysteps, :xsteps]
+                    except NotImplementedError:
+                        values = None
+                    if values is not None:
+                        '''Pixels are taken column by column, and those with no value or
+                        a value of zero are skipped, as when computing them one by one'''
+                        cols, rows = np.nonzero(((values != 0) & ~np.isnan(values)).T)
+                        xs = rectangle.xMinimum() + cols * layer.rasterUnitsPerPixelX()
+                        ys = rectangle.yMinimum() + rows * layer.rasterUnitsPerPixelY()
+                        self.data[time] = zip(values[rows, cols].tolist(), zip(xs.tolist(), ys.tolist()))
+                    else:
+                        self.data[time] = []
+                        for col in range(xsteps):
+                            x = rectangle.xMinimum() + col * layer.rasterUnitsPerPixelX()
+                            for row in range(ysteps):
+                                y = rectangle.yMinimum() + row * layer.rasterUnitsPerPixelY()
+                                pixel = QgsPoint(col, row)
+                                value = self.parameter.value(roi, pixel, bands)
+                                if value:
+                                    self.data[time].append((value, (x, y)))
                     end = timelib.time()
                     logger.info("Plot data computed from ROI data in %s seconds" % (str(end-start)))
                 closeProgressBar()
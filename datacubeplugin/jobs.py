@@ -0,0 +1,197 @@
+import os
+import json
+import shutil
+import hashlib
+import time as timelib
+from datacubeplugin.cache import cacheFolder
+
+def jobsFolder():
+    return os.path.join(cacheFolder(), "jobs")
+
+def _canonical(parameters):
+    return json.loads(json.dumps(parameters, sort_keys=True, default=str))
+
+def findBaseJob(parameters, folder=None):
+    '''
+    Returns the finished job with the same parameters as the passed ones, except for
+    having only the first ones of their list of layers, and with the most layers among
+    those. If it stored the state of its tiles, a mosaic with the passed parameters
+    can be computed updating that state with the rest of layers. Returns None if there
+    is no such job
+    '''
+    folder = folder or jobsFolder()
+    if not os.path.isdir(folder):
+        return None
+    parameters = _canonical(parameters)
+    layers = parameters["layers"]
+    best = None
+    for name in os.listdir(folder):
+        try:
+            with open(os.path.join(folder, name, "manifest.json")) as f:
+                baseParameters = json.load(f)["parameters"]
+            baseLayers = baseParameters["layers"]
+        except (IOError, ValueError, KeyError):
+            continue
+        if not 0 < len(baseLayers) < len(layers) or layers[:len(baseLayers)] != baseLayers:
+            continue
+        if any(baseParameters.get(k) != v for k, v in parameters.items() if k != "layers"):
+            continue
+        job = MosaicJob(baseParameters, folder)
+        if job.finishedOutput() is not None and os.path.isdir(os.path.join(job.folder, "states")):
+            if best is None or len(baseLayers) > len(best.parameters["layers"]):
+                best = job
+    return best
+
+def _folderSize(folder):
+    size = 0
+    for root, dirs, files in os.walk(folder):
+        for f in files:
+            try:
+                size += os.path.getsize(os.path.join(root, f))
+            except OSError:
+                pass
+    return size
+
+def evictJobs(maxSize, keep=None, folder=None):
+    '''
+    Removes the folders of the least recently used jobs, finished or not, until the
+    total size of all of them is not larger than maxSize (in bytes). Jobs are used
+    when their manifest is saved or touched. Folders in the keep list are not removed.
+    Returns the number of removed jobs
+    '''
+    folder = folder or jobsFolder()
+    if not os.path.isdir(folder):
+        return 0
+    keep = set(os.path.normcase(os.path.abspath(f)) for f in keep or [])
+    jobs = []
+    for name in os.listdir(folder):
+        path = os.path.join(folder, name)
+        if os.path.isdir(path):
+            manifest = os.path.join(path, "manifest.json")
+            lastAccess = os.path.getmtime(manifest if os.path.exists(manifest) else path)
+            jobs.append((lastAccess, path, _folderSize(path)))
+    total = sum(size for _, _, size in jobs)
+    removed = 0
+    for lastAccess, path, size in sorted(jobs):
+        if total <= maxSize:
+            break
+        if os.path.normcase(os.path.abspath(path)) in keep:
+            continue
+        shutil.rmtree(path, ignore_errors=True)
+        total -= size
+        removed += 1
+    return removed
+
+class MosaicJob():
+
+    '''
+    Manifest of a mosaic job, stored in a folder identified by the parameters of the job.
+    It records which input tiles have been retrieved and which output tiles have been
+    computed, so running the same job again after it has been interrupted skips the
+    work that was already done.
+
+    Files are recorded by their path relative to the folder of the job, and they
+    are only considered done if they still exist
+    '''
+
+    SAVE_INTERVAL = 2
+
+    def __init__(self, parameters, folder=None):
+        self.parameters = _canonical(parameters)
+        self.id = hashlib.sha1(json.dumps(self.parameters, sort_keys=True)).hexdigest()
+        self.folder = os.path.join(folder or jobsFolder(), self.id)
+        self.manifestFile = os.path.join(self.folder, "manifest.json")
+        self.inputs = set()
+        self.outputs = set()
+        self.output = None
+        self._lastSaved = 0
+        try:
+            with open(self.manifestFile) as f:
+                manifest = json.load(f)
+            if manifest["parameters"] == self.parameters:
+                self.inputs = set(manifest["inputs"])
+                self.outputs = set(manifest["outputs"])
+                self.output = manifest["output"]
+        except (IOError, ValueError, KeyError):
+            pass
+
+    def _relpath(self, filename):
+        return os.path.relpath(filename, self.folder).replace(os.sep, "/")
+
+    def _exists(self, relpath):
+        return os.path.exists(os.path.join(self.folder, relpath))
+
+    def subfolder(self, *names):
+        folder = os.path.join(self.folder, *names)
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+        return folder
+
+    def touch(self):
+        '''Marks the job as used, so it is not removed before other jobs when evicting them'''
+        if os.path.exists(self.manifestFile):
+            os.utime(self.manifestFile, None)
+
+    def isResumed(self):
+        return bool(self.inputs or self.outputs)
+
+    def isInputDone(self, filename):
+        relpath = self._relpath(filename)
+        return relpath in self.inputs and self._exists(relpath)
+
+    def setInputDone(self, filename):
+        self.inputs.add(self._relpath(filename))
+        self.save()
+
+    def isOutputDone(self, filename):
+        relpath = self._relpath(filename)
+        return relpath in self.outputs and self._exists(relpath)
+
+    def setOutputDone(self, filename):
+        self.outputs.add(self._relpath(filename))
+        self.save()
+
+    def finishedOutput(self):
+        '''Returns the final output file if the job was already finished, or None otherwise'''
+        if self.output is not None and self._exists(self.output):
+            return os.path.join(self.folder, self.output)
+        return None
+
+    def finish(self, outputFile, keep=None):
+        '''
+        Records the final output of the job and deletes all other files and folders in
+        the folder of the job, except the ones in the keep list
+        '''
+        self.output = self._relpath(outputFile)
+        self.inputs = set()
+        keep = set([os.path.basename(outputFile), os.path.basename(self.manifestFile)] +
+                   [os.path.basename(f) for f in keep or [] if f is not None])
+        self.outputs = set()
+        self.save(force=True)
+        for name in os.listdir(self.folder):
+            if name not in keep:
+                path = os.path.join(self.folder, name)
+                if os.path.isdir(path):
+                    shutil.rmtree(path, ignore_errors=True)
+                else:
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        pass
+
+    def save(self, force=False):
+        '''Writes the manifest, at most once every SAVE_INTERVAL seconds unless forced'''
+        now = timelib.time()
+        if not force and now - self._lastSaved < self.SAVE_INTERVAL:
+            return
+        self._lastSaved = now
+        self.subfolder()
+        manifest = {"parameters": self.parameters, "inputs": sorted(self.inputs),
+                    "outputs": sorted(self.outputs), "output": self.output}
+        tmpFile = self.manifestFile + ".tmp"
+        with open(tmpFile, "w") as f:
+            json.dump(manifest, f, indent=2)
+        '''Replacing the file is atomic on POSIX systems, but fails on Windows if it exists'''
+        if os.name == "nt" and os.path.exists(self.manifestFile):
+            os.remove(self.manifestFile)
+        os.rename(tmpFile, self.manifestFile)
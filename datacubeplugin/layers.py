@@ -1,7 +1,6 @@
 from collections import defaultdict
 from qgis.core import  QgsDataSourceURI
-from osgeo import gdal
-from osgeo.gdalconst import GA_ReadOnly
+from datacubeplugin.readers import datasets
 
 _layers = {}
 _mosaicLayers = defaultdict(lambda:defaultdict(list))
@@ -17,21 +16,10 @@ def uriFromComponents(url, coverageName, time):
     return uri
 
 def getRowArray(filename, bandidx, row, width):
-    ds = gdal.Open(filename, GA_ReadOnly)
-    band = ds.GetRasterBand(bandidx)
-    array = band.ReadAsArray(0, row, width, 1)
-    return array
+    return datasets.readBands(filename, [bandidx], window=(0, row, width, 1))[0]
 
 def getArray(filename, bandidx):
-    ds = gdal.Open(filename, GA_ReadOnly)
-    band = ds.GetRasterBand(bandidx)
-    array = band.ReadAsArray()
-    return array
+    return datasets.readBands(filename, [bandidx])[0]
 
 def getBandArrays(filename):
-    ds = gdal.Open(filename, GA_ReadOnly)
-    arrays = []
-    for b in range(ds.RasterCount):
-        band = ds.GetRasterBand(b+1)
-        arrays.append(band.ReadAsArray())
-    return arrays
\ No newline at end of file
+    return list(datasets.readBands(filename))
@@ -0,0 +1,554 @@
+import os
+import sys
+import logging
+import tempfile
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+from collections import deque
+import time as timelib
+import numpy as np
+from osgeo import gdal, gdal_array
+from datacubeplugin.mosaicfunctions import noDataValue
+from datacubeplugin.readers import datasets
+
+logger = logging.getLogger('datacube')
+
+def _nbytes(arrays):
+    return sum(a.nbytes for a in arrays if a is not None)
+
+def _scratchStack(files, bands, qaBand, qaMask, folder):
+    '''
+    Copies the passed bands of a list of files into a (bands, files, y, x) array mapped
+    to a scratch file in the passed folder, and the mask of valid values into a
+    (files, y, x) one, reading one file at a time. Returns both arrays and the names
+    of their files. If folder is None, arrays are kept in memory instead
+    '''
+    ds = datasets.dataset(files[0])
+    dtype = gdal_array.GDALTypeCodeToNumericTypeCode(ds.GetRasterBand(1).DataType)
+    shape = (ds.RasterYSize, ds.RasterXSize)
+    del ds
+    scratchFiles = []
+    if folder is None:
+        stack = np.empty((len(bands), len(files)) + shape, dtype=dtype)
+        mask = np.empty((len(files),) + shape, dtype=bool)
+    else:
+        for suffix in [".stack", ".mask"]:
+            handle, filename = tempfile.mkstemp(suffix=suffix, dir=folder)
+            os.close(handle)
+            scratchFiles.append(filename)
+        stack = np.memmap(scratchFiles[0], dtype=dtype, mode="w+", shape=(len(bands), len(files)) + shape)
+        mask = np.memmap(scratchFiles[1], dtype=bool, mode="w+", shape=(len(files),) + shape)
+    for i, filename in enumerate(files):
+        data = datasets.readBands(filename)
+        stack[:, i] = data[bands]
+        if qaBand is not None:
+            mask[i] = qaMask.validMask(data[qaBand])
+        else:
+            mask[i] = True
+        data = None
+    return stack, mask, scratchFiles
+
+def _computeByRows(mosaicFunction, stack, mask, bandNames, memoryBudget):
+    '''
+    Computes a (time, y, x) stack, or a (bands, time, y, x) one for functions that
+    don't operate band by band, in chunks of rows that fit in the memory budget.
+    Pixels are computed independently, so the result is the same as computing the
+    whole stack at once. Returns the result, with the outputs of the function along
+    its first axis if there are several of them, and the memory used by each chunk
+    '''
+    height, width = stack.shape[-2:]
+    rowShape = stack.shape[:-2] + (1, width)
+    rowMemory = (int(np.prod(rowShape)) * stack.dtype.itemsize + mask.shape[0] * width
+                 + mosaicFunction.workingMemory(rowShape, stack.dtype))
+    rows = max(1, int(memoryBudget // rowMemory))
+    result = None
+    for y in xrange(0, height, rows):
+        chunk = np.array(stack[..., y:y + rows, :])
+        chunkMask = np.array(mask[:, y:y + rows])
+        if mosaicFunction.bandByBand:
+            chunkResult = np.asarray(mosaicFunction.compute(chunk, chunkMask))
+        else:
+            chunkResult = np.asarray(mosaicFunction.compute(chunk, chunkMask, bandNames))
+        if result is None:
+            result = np.empty(chunkResult.shape[:-2] + (height, width), dtype=chunkResult.dtype)
+        result[..., y:y + rows, :] = chunkResult
+    return result, rows * rowMemory
+
+def _saveStates(filename, states, count):
+    arrays = {"count": count}
+    for i, state in enumerate(states):
+        for name, values in state.items():
+            arrays["%i_%s" % (i, name)] = values
+    '''np.savez adds the .npz extension if the file name doesn't have it'''
+    with open(filename, "wb") as f:
+        np.savez(f, **arrays)
+
+def _loadStates(filename):
+    arrays = np.load(filename)
+    states = {}
+    for key in arrays.files:
+        if key != "count":
+            i, name = key.split("_", 1)
+            states.setdefault(int(i), {})[name] = arrays[key]
+    return [states[i] for i in sorted(states)], arrays["count"]
+
+def _tileOutputs(mosaicFunction, bandNames, qaBand, results, count):
+    '''Returns the (name, values) pairs of the bands of an output tile, given the
+    results of the data bands, in the order of the output bands, and the number of
+    valid values of each pixel'''
+    results = iter(results)
+    outputs = []
+    for band, bandName in enumerate(bandNames):
+        if band == qaBand:
+            outputs.extend(zip(mosaicFunction.qaOutputBands(bandName), mosaicFunction.computeQAOutputs(count)))
+        else:
+            outputs.extend((name, next(results)) for name in mosaicFunction.outputBands(bandName))
+    return outputs
+
+def _writeTile(dstFilename, files, outputs, outType):
+    '''Writes the (name, values) pairs of an output tile as the bands of a new
+    file, using the first one of the input files of the tile as template'''
+    start = timelib.time()
+    ds = datasets.dataset(files[0])
+    width = ds.RasterXSize
+    height = ds.RasterYSize
+    geotransform = ds.GetGeoTransform()
+    projection = ds.GetProjection()
+    del ds
+    datasets.close(files)
+    driver = gdal.GetDriverByName("GTiff")
+    datatype = gdal_array.NumericTypeCodeToGDALTypeCode(outType.type)
+    dstDs= driver.Create(dstFilename, width, height, len(outputs), datatype)
+
+    outNoData = noDataValue(outType)
+    for b, (name, values) in enumerate(outputs):
+        gdalBand = dstDs.GetRasterBand(b+1)
+        gdalBand.SetNoDataValue(outNoData)
+        gdalBand.SetDescription(name)
+        gdalBand.WriteArray(values)
+        gdalBand.FlushCache()
+
+    dstDs.SetGeoTransform(geotransform)
+    dstDs.SetProjection(projection)
+
+    del dstDs
+
+    end = timelib.time()
+    logger.info("Tile %s written to local file in %s seconds." % (dstFilename, str(end-start)))
+
+def processTile(mosaicFunction, files, bandNames, qaBand, qaMask, dstFilename, memoryBudget=None,
+                stateFilename=None, baseStateFilename=None):
+    '''
+    Computes the mosaic of a single tile, given the files with the data of that
+    tile for each time position, and writes it to dstFilename, using the first
+    file as template.
+
+    If memoryBudget (in bytes) is passed and the stack of the tile doesn't fit in it,
+    the stack is copied to scratch files next to dstFilename and computed in chunks.
+
+    For streaming functions, the state of the tile after folding all the files is
+    saved to stateFilename, if passed. If baseStateFilename is passed, the files are
+    folded into the state stored in it, so a mosaic can be updated with new dates
+    (which must be later than the ones in that state) without reading the old ones.
+
+    This runs in the worker processes when the mosaic is computed in parallel,
+    so it should not depend on QGIS objects
+    '''
+    tilestart = timelib.time()
+    start = timelib.time()
+    outputs = []
+    '''Data is kept in the type of the source files. Output tiles use the type that
+    the mosaic function produces from it, with a no data value that can be represented
+    with that type'''
+    ds = datasets.dataset(files[0])
+    sourceType = gdal_array.GDALTypeCodeToNumericTypeCode(ds.GetRasterBand(1).DataType)
+    outType = mosaicFunction.outputType(sourceType)
+    outNoData = noDataValue(outType)
+    dataBands = [band for band in range(len(bandNames)) if band != qaBand]
+    stackShape = (len(files), ds.RasterYSize, ds.RasterXSize)
+    if not mosaicFunction.bandByBand:
+        stackShape = (len(dataBands),) + stackShape
+    stackMemory = (int(np.prod(stackShape)) * np.dtype(sourceType).itemsize + int(np.prod(stackShape[-3:]))
+                   + mosaicFunction.workingMemory(stackShape, sourceType))
+    outOfCore = bool(memoryBudget) and not mosaicFunction.streaming and stackMemory > memoryBudget
+    del ds
+    peakMemory = 0
+    if qaBand is not None and not mosaicFunction.streaming and not outOfCore:
+        mask = qaMask.validMask(datasets.readStack(files, [qaBand + 1])[:, 0])
+        count = mask.sum(axis=0)
+        invalid = count == 0
+    else:
+        mask = None
+        count = np.full(stackShape[-2:], len(files), np.int32)
+        invalid = None
+
+    def toOutput(result):
+        '''GDAL clamps values out of the range of the output type when writing, so
+        float results of integer tiles have to use the no data value of that type'''
+        if invalid is not None and result.dtype.kind == "f" and outType.kind != "f":
+            result[invalid] = outNoData
+        return result
+    end = timelib.time()
+    logger.info("QA band prepared in %s seconds" % (str(end-start)))
+
+    if mosaicFunction.streaming:
+        '''
+        Dates are read one at a time, with all their bands in a single call, and
+        folded into a running state for each band, so memory does not depend on
+        the number of dates'''
+        start = timelib.time()
+        dataBandNames = [bandNames[band] for band in dataBands]
+        if baseStateFilename is not None:
+            states, count = _loadStates(baseStateFilename)
+        else:
+            states = None
+        for filename in files:
+            data = datasets.readBands(filename)
+            if qaBand is not None:
+                valid = qaMask.validMask(data[qaBand])
+            else:
+                valid = np.ones(data.shape[1:], dtype=bool)
+            if states is None:
+                if mosaicFunction.bandByBand:
+                    states = [mosaicFunction.startState(data.shape[1:], data.dtype) for band in dataBands]
+                else:
+                    states = [mosaicFunction.startState((len(dataBands),) + data.shape[1:], data.dtype)]
+                count = np.zeros(data.shape[1:], dtype=np.int32)
+            count += valid
+            if mosaicFunction.bandByBand:
+                for band, state in zip(dataBands, states):
+                    mosaicFunction.accumulate(state, data[band], valid)
+            else:
+                mosaicFunction.accumulate(states[0], data[dataBands], valid, dataBandNames)
+            memory = _nbytes([data, valid, count]) + sum(_nbytes(state.values()) for state in states)
+            peakMemory = max(peakMemory, memory)
+            data = None
+        if stateFilename is not None:
+            _saveStates(stateFilename, states, count)
+        if qaBand is not None:
+            invalid = count == 0
+        if mosaicFunction.bandByBand:
+            results = []
+            for band, state in zip(dataBands, states):
+                result = mosaicFunction.stateResult(state, count)
+                results.extend(result if len(mosaicFunction.outputBands(bandNames[band])) > 1 else [result])
+        else:
+            results = mosaicFunction.stateResult(states[0], count)
+        outputs = _tileOutputs(mosaicFunction, bandNames, qaBand, [toOutput(r) for r in results], count)
+        states = None
+        end = timelib.time()
+        logger.info("Tile %s read and processed in %s seconds." % (dstFilename, str(end-start)))
+    elif outOfCore:
+        start = timelib.time()
+        logger.info("Tile %s needs %.1f MB. Computing it out of core" % (dstFilename, stackMemory / (1024.0 * 1024.0)))
+        stack, mask, scratchFiles = _scratchStack(files, dataBands, qaBand, qaMask, os.path.dirname(dstFilename))
+        try:
+            count = mask.sum(axis=0)
+            if qaBand is not None:
+                invalid = count == 0
+            if mosaicFunction.bandByBand:
+                results = []
+                for i, band in enumerate(dataBands):
+                    result, memory = _computeByRows(mosaicFunction, stack[i], mask, None, memoryBudget)
+                    if len(mosaicFunction.outputBands(bandNames[band])) == 1:
+                        result = [result]
+                    results.extend(result)
+            else:
+                results, memory = _computeByRows(mosaicFunction, stack, mask,
+                                                 [bandNames[band] for band in dataBands], memoryBudget)
+            peakMemory = memory + _nbytes([count, invalid]) + _nbytes(results)
+            outputs = _tileOutputs(mosaicFunction, bandNames, qaBand, [toOutput(r) for r in results], count)
+        finally:
+            del stack, mask
+            for filename in scratchFiles:
+                try:
+                    os.remove(filename)
+                except OSError:
+                    pass
+        end = timelib.time()
+        logger.info("Tile %s read and processed in %s seconds." % (dstFilename, str(end-start)))
+    elif mosaicFunction.bandByBand:
+        '''
+        We operate band by band, since a given band in the the final result
+        layer depends only on the values of that band in the input layers,
+        not the value of other bands'''
+        start = timelib.time()
+        for band, bandName in enumerate(bandNames):
+            if band == qaBand:
+                outputs.extend(zip(mosaicFunction.qaOutputBands(bandName), mosaicFunction.computeQAOutputs(count)))
+            else:
+                bandData = datasets.readStack(files, [band + 1])[:, 0]
+                names = mosaicFunction.outputBands(bandName)
+                result = mosaicFunction.compute(bandData, mask)
+                results = [toOutput(r) for r in (result if len(names) > 1 else [result])]
+                memory = (_nbytes([mask, invalid, bandData]) + _nbytes(results)
+                          + _nbytes([v for n, v in outputs])
+                          + mosaicFunction.workingMemory(bandData.shape, bandData.dtype))
+                peakMemory = max(peakMemory, memory)
+                outputs.extend(zip(names, results))
+                bandData = None
+        end = timelib.time()
+        logger.info("Tile %s read and processed in %s seconds." % (dstFilename, str(end-start)))
+    else:
+        '''
+        We operate with all bands at once, and the output layer will
+        have only each band computed from the set of them in the input
+        layers. All bands of each file are read with a single call'''
+        start = timelib.time()
+        bandList = [band + 1 for band in range(len(bandNames)) if band != qaBand]
+        dataBandNames = [bandNames[band - 1] for band in bandList]
+        bandData = datasets.readStack(files, bandList).transpose(1, 0, 2, 3)
+        end = timelib.time()
+        logger.info("Tile %s data read and prepared in %s seconds." % (dstFilename, str(end-start)))
+        start = timelib.time()
+        results = [toOutput(b) for b in mosaicFunction.compute(bandData, mask, dataBandNames)]
+        end = timelib.time()
+        logger.info("Tile %s data processed in %s seconds." % (dstFilename, str(end-start)))
+        peakMemory = (_nbytes([mask, invalid, bandData]) + _nbytes(results)
+                      + mosaicFunction.workingMemory(bandData.shape, bandData.dtype))
+        outputs = _tileOutputs(mosaicFunction, bandNames, qaBand, results, count)
+        bandData = None
+
+    _writeTile(dstFilename, files, outputs, outType)
+    del outputs
+
+    tileend = timelib.time()
+    logger.info("Total time to process tile: %s seconds." % (str(tileend-tilestart)))
+    logger.info("Estimated peak memory used to process tile %s: %.1f MB."
+                % (dstFilename, peakMemory / (1024.0 * 1024.0)))
+
+    return dstFilename
+
+def processTilePeriods(mosaicFunction, files, periods, bandNames, qaBand, qaMask, dstFilenames,
+                       memoryBudget=None):
+    '''
+    Computes the mosaics of a single tile for several periods, given the files with
+    the data of that tile for each time position, sorted by time, and the (start, end)
+    range of the files of each period. Each file is read only once, and the mosaic of
+    each period is written to the corresponding file in dstFilenames.
+
+    The data of all the files is kept in memory or, if it doesn't fit in memoryBudget
+    (in bytes), copied to scratch files next to the output files. Periods are computed
+    in chunks of rows that fit in the memory budget.
+
+    Returns the list of output files
+    '''
+    tilestart = timelib.time()
+    ds = datasets.dataset(files[0])
+    sourceType = gdal_array.GDALTypeCodeToNumericTypeCode(ds.GetRasterBand(1).DataType)
+    outType = mosaicFunction.outputType(sourceType)
+    outNoData = noDataValue(outType)
+    dataBands = [band for band in range(len(bandNames)) if band != qaBand]
+    dataBandNames = [bandNames[band] for band in dataBands]
+    stackMemory = (len(dataBands) + 1) * len(files) * ds.RasterYSize * ds.RasterXSize * np.dtype(sourceType).itemsize
+    del ds
+    folder = None
+    if memoryBudget and stackMemory > memoryBudget:
+        folder = os.path.dirname(dstFilenames[0])
+        logger.info("Tile %s needs %.1f MB. Computing it out of core" % (files[0], stackMemory / (1024.0 * 1024.0)))
+    start = timelib.time()
+    stack, mask, scratchFiles = _scratchStack(files, dataBands, qaBand, qaMask, folder)
+    end = timelib.time()
+    logger.info("Tile data read and prepared in %s seconds." % (str(end-start)))
+    try:
+        for (first, last), dstFilename in zip(periods, dstFilenames):
+            start = timelib.time()
+            periodMask = mask[first:last]
+            count = periodMask.sum(axis=0)
+            invalid = count == 0 if qaBand is not None else None
+            rowsBudget = memoryBudget or sys.maxsize
+            if mosaicFunction.bandByBand:
+                results = []
+                for i, band in enumerate(dataBands):
+                    result, memory = _computeByRows(mosaicFunction, stack[i, first:last], periodMask, None, rowsBudget)
+                    results.extend(result if len(mosaicFunction.outputBands(bandNames[band])) > 1 else [result])
+            else:
+                results, memory = _computeByRows(mosaicFunction, stack[:, first:last], periodMask,
+                                                 dataBandNames, rowsBudget)
+            for result in results:
+                if invalid is not None and result.dtype.kind == "f" and outType.kind != "f":
+                    result[invalid] = outNoData
+            _writeTile(dstFilename, files, _tileOutputs(mosaicFunction, bandNames, qaBand, results, count), outType)
+            end = timelib.time()
+            logger.info("Tile %s processed in %s seconds." % (dstFilename, str(end-start)))
+    finally:
+        '''Views of the scratch arrays keep their files mapped, and they cannot be
+        removed on Windows while they are'''
+        periodMask = results = None
+        del stack, mask
+        for filename in scratchFiles:
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+    datasets.close(files)
+    tileend = timelib.time()
+    logger.info("Total time to process tile for %i periods: %s seconds." % (len(periods), str(tileend-tilestart)))
+    return dstFilenames
+
+class MosaicWriter():
+
+    '''
+    Writes the output tiles of a mosaic into a single, internally tiled and compressed
+    GeoTIFF file covering the passed (xmin, ymin, xmax, ymax) extent. Tiles can be
+    written in any order as soon as they are computed. If they are aligned with the
+    blocks of the output file, each block is compressed only once.
+
+    Overviews are built when the file is closed, using all available CPUs
+    '''
+
+    def __init__(self, filename, extent, blockSize=256):
+        self.filename = filename
+        self.extent = extent
+        self.blockSize = blockSize
+        self._ds = None
+
+    def _create(self, template):
+        xmin, ymin, xmax, ymax = self.extent
+        gt = template.GetGeoTransform()
+        width = int(round((xmax - xmin) / gt[1]))
+        height = int(round((ymax - ymin) / -gt[5]))
+        band = template.GetRasterBand(1)
+        dataType = band.DataType
+        isFloat = np.dtype(gdal_array.GDALTypeCodeToNumericTypeCode(dataType)).kind == "f"
+        self._predictor = "3" if isFloat else "2"
+        options = ["TILED=YES", "BLOCKXSIZE=%i" % self.blockSize, "BLOCKYSIZE=%i" % self.blockSize,
+                   "COMPRESS=DEFLATE", "PREDICTOR=%s" % self._predictor, "BIGTIFF=IF_SAFER"]
+        driver = gdal.GetDriverByName("GTiff")
+        self._ds = driver.Create(self.filename, width, height, template.RasterCount, dataType, options)
+        if self._ds is None:
+            raise IOError("Could not create file %s" % self.filename)
+        self._geotransform = (xmin, gt[1], gt[2], ymax, gt[4], gt[5])
+        self._ds.SetGeoTransform(self._geotransform)
+        self._ds.SetProjection(template.GetProjection())
+        noData = band.GetNoDataValue()
+        for b in xrange(template.RasterCount):
+            dstBand = self._ds.GetRasterBand(b + 1)
+            dstBand.SetDescription(template.GetRasterBand(b + 1).GetDescription())
+            if noData is not None:
+                dstBand.SetNoDataValue(noData)
+
+    def write(self, tileFilename):
+        ds = gdal.Open(tileFilename)
+        if ds is None:
+            raise IOError("Could not open file %s" % tileFilename)
+        if self._ds is None:
+            self._create(ds)
+        gt = ds.GetGeoTransform()
+        xOff = int(round((gt[0] - self._geotransform[0]) / gt[1]))
+        yOff = int(round((gt[3] - self._geotransform[3]) / gt[5]))
+        for b in xrange(ds.RasterCount):
+            self._ds.GetRasterBand(b + 1).WriteArray(ds.GetRasterBand(b + 1).ReadAsArray(), xOff, yOff)
+        del ds
+
+    def close(self, overviews=True):
+        '''Builds the overviews and closes the file. Returns the name of the file, or None
+        if no tile was written'''
+        if self._ds is None:
+            return None
+        if overviews:
+            start = timelib.time()
+            levels = []
+            factor = 2
+            while max(self._ds.RasterXSize, self._ds.RasterYSize) / factor >= self.blockSize:
+                levels.append(factor)
+                factor *= 2
+            if levels:
+                config = {"GDAL_NUM_THREADS": "ALL_CPUS", "COMPRESS_OVERVIEW": "DEFLATE",
+                          "PREDICTOR_OVERVIEW": self._predictor}
+                previous = {k: gdal.GetConfigOption(k) for k in config}
+                try:
+                    for k, v in config.iteritems():
+                        gdal.SetConfigOption(k, v)
+                    self._ds.BuildOverviews("NEAREST", levels)
+                finally:
+                    for k, v in previous.iteritems():
+                        gdal.SetConfigOption(k, v)
+            end = timelib.time()
+            logger.info("Overviews for %s built in %s seconds." % (self.filename, str(end-start)))
+        self._ds.FlushCache()
+        self._ds = None
+        return self.filename
+
+def _processTileTask(task):
+    function, args = task
+    return function(*args)
+
+def workersCount(workers):
+    '''Number of processes to use for a configured number of workers. 0 means one per CPU'''
+    try:
+        workers = int(workers)
+    except (TypeError, ValueError):
+        workers = 0
+    if workers <= 0:
+        try:
+            workers = multiprocessing.cpu_count()
+        except NotImplementedError:
+            workers = 1
+    return workers
+
+class TilePipeline():
+
+    '''
+    Computes tiles in the background while the caller keeps retrieving the data for
+    the following ones. Tiles are processed by a pool of processes or, if a single
+    worker is used, by a thread in the QGIS process.
+
+    Each submitted tile is defined by the arguments to pass to the function that
+    computes it (processTile, by default), whose second argument must be the list of
+    input files of the tile. At most
+    maxPending tiles can be waiting to be processed, so submit blocks until one of them
+    is finished if that limit is reached. That bounds the disk and memory used by tiles
+    that have already been retrieved, and input files are deleted once their tile is
+    processed.
+    '''
+
+    def __init__(self, workers=1, maxPending=None, function=processTile):
+        self.function = function
+        self.maxPending = maxPending or 2 * workers
+        self.pending = deque()
+        self.pool = None
+        if workers > 1:
+            if os.name == "nt":
+                '''sys.executable is the QGIS executable, not a python interpreter'''
+                multiprocessing.set_executable(os.path.join(sys.exec_prefix, "pythonw.exe"))
+            try:
+                self.pool = multiprocessing.Pool(workers)
+                logger.info("Processing tiles with %i processes" % workers)
+            except Exception, e:
+                logger.warning("Could not create pool of processes (%s). Tiles will be computed in a single thread" % str(e))
+        if self.pool is None:
+            self.pool = ThreadPool(1)
+
+    def submit(self, task):
+        '''Adds a tile to the queue and returns the output files of the tiles
+        that have been finished since the last call'''
+        finished = []
+        while self.pending and (self.pending[0][0].ready() or len(self.pending) >= self.maxPending):
+            finished.append(self._next())
+        self.pending.append((self.pool.apply_async(_processTileTask, ((self.function, task),)), task))
+        return finished
+
+    def _next(self):
+        result, task = self.pending.popleft()
+        dstFilename = result.get()
+        for f in task[1]:
+            try:
+                os.remove(f)
+            except OSError:
+                pass
+        return dstFilename
+
+    def finish(self):
+        '''Yields the output files of the remaining tiles as they are finished'''
+        try:
+            while self.pending:
+                yield self._next()
+            self.pool.close()
+        finally:
+            self.terminate()
+
+    def terminate(self):
+        self.pending.clear()
+        self.pool.terminate()
+        self.pool.join()
@@ -1,37 +1,184 @@
 import numpy as np
+from datacubeplugin.plotparams import NDVI, NDWI, WOFS, fractionalCover, FRACTIONAL_COVER_BANDS
 import math
-try:
-    import hdmedians as hd
-    geoMedianOk = True
-except:
-    geoMedianOk = False
-
-#to be able to use the geomedian library if numpy < 1.9
-np.nanmedian=np.median
 
 NO_DATA = -99999
 
+def noDataValue(dtype):
+    '''Returns NO_DATA if it can be represented with the passed type, or the minimum
+    (for signed types) or maximum (for unsigned ones) value of that type otherwise'''
+    dtype = np.dtype(dtype)
+    if dtype.kind == "f":
+        return NO_DATA
+    info = np.iinfo(dtype)
+    if info.min <= NO_DATA <= info.max:
+        return NO_DATA
+    return info.min if info.min < 0 else info.max
+
+def workingType(dtype):
+    '''Returns the floating point type to use for computations with data of the passed
+    type. float32 represents exactly all the values of integer types up to 16 bits'''
+    dtype = np.dtype(dtype)
+    if dtype == np.float64 or (dtype.kind != "f" and dtype.itemsize > 2):
+        return np.dtype(np.float64)
+    return np.dtype(np.float32)
+
+def _gather(stack, idx):
+    '''Picks, for each pixel, the element of a (time, y, x) stack at the time index given
+    in the (y, x) idx array'''
+    rows, cols = np.ogrid[:idx.shape[0], :idx.shape[1]]
+    return stack[idx, rows, cols]
+
+def geometricMedian(stack, mask, tolerance=1e-6, maxIterations=500):
+    '''
+    Computes the geometric median of all the pixels of a (bands, time, y, x) stack
+    at once, using the Weiszfeld algorithm with the Vardi-Zhang modification for
+    estimates that fall onto one of the observations.
+
+    Observations that are masked or have a NaN value in any band are ignored.
+    Iterations for a pixel stop when the estimate moves less than tolerance times
+    its norm. Returns a (bands, y, x) array, with NaN where there are no valid
+    observations
+    '''
+    nBands, nTimes = stack.shape[:2]
+    shape = stack.shape[2:]
+    X = stack.reshape(nBands, nTimes, -1).astype(workingType(stack.dtype))
+    valid = mask.reshape(nTimes, -1) & ~np.isnan(X).any(axis=0)
+    X[:, ~valid] = 0
+    count = valid.sum(axis=0)
+    median = X.sum(axis=1) / np.maximum(count, 1).astype(X.dtype)
+    median[:, count == 0] = np.nan
+
+    '''We iterate only over the pixels that have not converged yet. To avoid copying
+    the data on each iteration, the working set is compacted only when it has
+    been reduced to half its size'''
+    idx = np.nonzero(count)[0]
+    Xw, validw, estimate = X[:, :, idx], valid[:, idx], median[:, idx]
+    active = np.ones(len(idx), dtype=bool)
+    for _ in xrange(maxIterations):
+        if not active.any():
+            break
+        if active.sum() < len(active) / 2:
+            median[:, idx] = estimate
+            Xw, validw, estimate, idx = Xw[:, :, active], validw[:, active], estimate[:, active], idx[active]
+            active = active[active]
+        diff = Xw - estimate[:, np.newaxis, :]
+        dist = np.sqrt((diff * diff).sum(axis=0))
+        nonzero = validw & (dist > 0)
+        distInv = np.where(nonzero, 1.0 / np.where(nonzero, dist, 1), 0)
+        distInvSum = distInv.sum(axis=0)
+        T = (Xw * distInv).sum(axis=1) / np.where(distInvSum > 0, distInvSum, 1)
+        zeros = (validw & ~nonzero).sum(axis=0).astype(X.dtype)
+        r = np.sqrt((((T - estimate) * distInvSum) ** 2).sum(axis=0))
+        rInv = np.where(r > 0, zeros / np.where(r > 0, r, 1), 0)
+        newEstimate = np.maximum(0, 1 - rInv) * T + np.minimum(1, rInv) * estimate
+        newEstimate = np.where(distInvSum > 0, newEstimate, estimate)
+        shift = np.sqrt(((newEstimate - estimate) ** 2).sum(axis=0))
+        converged = shift <= tolerance * np.sqrt((newEstimate ** 2).sum(axis=0))
+        estimate[:, active] = newEstimate[:, active]
+        active &= ~converged
+    median[:, idx] = estimate
+
+    return median.reshape((nBands,) + shape)
+
 class MosaicFunction():
 
     bandByBand=True
+    #Functions that set this to True implement _computeArray, which receives the whole
+    #(time, y, x) stack and a boolean mask of valid values, instead of _compute, which
+    #is called once per pixel with the list of its valid values
+    vectorized = False
+    #Functions that set this to True implement _startState, _accumulate and _stateResult,
+    #which fold the values of each date into a running state, in time order, so the stack
+    #of all dates does not have to be in memory
+    streaming = False
+    #Functions that set this to True replace the QA band with a "count" band, with the
+    #number of valid values of each pixel, instead of a mask of the pixels with any
+    countOutput = False
+
+    def outputBands(self, bandName):
+        '''Returns the names of the output bands computed from an input band. If there is
+        more than one, compute returns them stacked along the first axis for that band'''
+        return [bandName]
+
+    def qaOutputBands(self, qaBandName):
+        '''Returns the names of the output bands computed from the mask of valid values,
+        which are written in the place of the QA band'''
+        return ["count"] if self.countOutput else [qaBandName]
+
+    def computeQAOutputs(self, count):
+        '''count is the number of valid values of each pixel'''
+        if self.countOutput:
+            return [count]
+        return [np.where(count > 0, 1, 255).astype(np.uint8)]
+
+    def outputBandNames(self, bandNames, qaBand):
+        names = []
+        for band, bandName in enumerate(bandNames):
+            if band == qaBand:
+                names.extend(self.qaOutputBands(bandName))
+            else:
+                names.extend(self.outputBands(bandName))
+        return names
+
+    def canBeComputed(self, bandNames):
+        return True
 
-    def computeQAMask(self, qas):
-        resultRows = []
-        for y in xrange(qas[0].shape[0]):
-            resultRow = []
-            for x in xrange(qas[0].shape[1]):
-                res  = 255
-                for qa in qas:
-                    valid = self.checkMask(qa.item(y, x))
-                    if valid:
-                        res = 1
-                        break
-                resultRow.append(res)
-            resultRows.append(resultRow)
-        return np.array(resultRows)
-
-    def compute(self, values, qa):
+    def outputType(self, dtype):
+        '''Returns the type of the output bands for input bands of the passed type'''
+        return np.dtype(dtype)
+
+    def workingMemory(self, shape, dtype):
+        '''Returns an estimate of the memory (in bytes) used by the temporary arrays
+        needed to compute a stack with the passed shape and type'''
+        return 0
+
+    def _fillNoData(self, result, valid):
+        '''Sets the no data value of the type of the result where there is no valid value'''
+        result = np.asarray(result)
+        return np.where(valid, result, noDataValue(result.dtype)).astype(result.dtype)
+
+    def startState(self, shape, dtype):
+        '''Returns the initial state of a band, as a dict of arrays'''
+        return self._startState(shape, np.dtype(dtype))
+
+    def accumulate(self, state, values, valid, bandNames=None):
+        '''Folds the values of a band for a date into its state. valid is a boolean
+        array telling which of them are valid. Functions that do not operate band by
+        band have a single state for all bands, and receive their values and names'''
+        if self.bandByBand:
+            self._accumulate(state, values, valid)
+        else:
+            self._accumulate(state, values, valid, bandNames)
+
+    def stateResult(self, state, count):
+        '''Returns the result for a band from its state, given the number of valid
+        values of each pixel, or the list of results for all bands if the function
+        does not operate band by band'''
         if self.bandByBand:
+            return self._fillNoData(self._stateResult(state), count > 0)
+        else:
+            return [self._fillNoData(band, count > 0) for band in self._stateResult(state)]
+
+    def compute(self, values, mask, bandNames=None):
+        '''mask is a boolean (time, y, x) array telling which values are valid, as
+        computed by QAMask.validMask, or None if all of them are valid. Functions
+        that do not operate band by band receive the names of the bands of the
+        values as well'''
+        if self.bandByBand and self.vectorized:
+            stack = np.asarray(values)
+            if mask is None:
+                mask = np.ones(stack.shape, dtype=bool)
+            result = self._computeArray(stack, mask)
+            return self._fillNoData(result, mask.any(axis=0))
+        elif self.vectorized:
+            stack = np.asarray(values)
+            if mask is None:
+                mask = np.ones(stack.shape[1:], dtype=bool)
+            result = self._computeArray(stack, mask, bandNames)
+            anyValid = mask.any(axis=0)
+            return [self._fillNoData(band, anyValid) for band in result]
+        elif self.bandByBand:
             resultRows = []
             for y in xrange(values[0].shape[0]):
                 resultRow = []
@@ -39,10 +186,7 @@ class MosaicFunction():
                     validValues = []
                     for idx, tpos in enumerate(values):
                         v = tpos.item(y, x)
-                        valid = True
-                        if qa is not None:
-                            valid = self.checkMask(qa[idx].item(y, x))
-                        if valid:
+                        if mask is None or mask.item(idx, y, x):
                             validValues.append(v)
                     if validValues:
                         resultRow.append(self._compute(validValues))
@@ -60,10 +204,7 @@ class MosaicFunction():
                         bandValidValues = []
                         for idx, tpos in enumerate(band):
                             v = tpos.item(y, x)
-                            valid = True
-                            if qa is not None:
-                                valid = self.checkMask(qa[idx].item(y, x))
-                            if valid:
+                            if mask is None or mask.item(idx, y, x):
                                 bandValidValues.append(float(v))
                         validValues.append(bandValidValues)
                     if len(validValues[0]):
@@ -77,39 +218,356 @@ class MosaicFunction():
                     resultRows[i].append(resultRow[i])
             return [np.array(b) for b in resultRows]
 
-    def checkMask(self, v):
-        return v is None or v not in [2, 4, 255]
-
 
 class MostRecent(MosaicFunction):
 
     name = "Most recent"
+    vectorized = True
+    streaming = True
 
     def _compute(self, values):
         return values[-1]
 
+    def _computeArray(self, stack, mask):
+        last = mask.shape[0] - 1 - np.argmax(mask[::-1], axis=0)
+        return _gather(stack, last)
+
+    def workingMemory(self, shape, dtype):
+        return shape[1] * shape[2] * (8 + np.dtype(dtype).itemsize)
+
+    def _startState(self, shape, dtype):
+        return {"value": np.zeros(shape, dtype=dtype)}
+
+    def _accumulate(self, state, values, valid):
+        state["value"][valid] = values[valid]
+
+    def _stateResult(self, state):
+        return state["value"]
+
 class LeastRecent(MosaicFunction):
 
     name = "Least recent"
+    vectorized = True
+    streaming = True
 
     def _compute(self, values):
         return values[0]
 
+    def _computeArray(self, stack, mask):
+        first = np.argmax(mask, axis=0)
+        return _gather(stack, first)
+
+    def workingMemory(self, shape, dtype):
+        return shape[1] * shape[2] * (8 + np.dtype(dtype).itemsize)
+
+    def _startState(self, shape, dtype):
+        return {"value": np.zeros(shape, dtype=dtype), "found": np.zeros(shape, dtype=bool)}
+
+    def _accumulate(self, state, values, valid):
+        first = valid & ~state["found"]
+        state["value"][first] = values[first]
+        state["found"] |= valid
+
+    def _stateResult(self, state):
+        return state["value"]
+
 class Median(MosaicFunction):
 
     name = "Median"
+    vectorized = True
 
     def _compute(self, values):
         return np.median(values)
 
+    def _computeArray(self, stack, mask):
+        '''Invalid values are set to NaN, which sorts after any number, so the valid
+        values of each pixel are at the beginning of the sorted stack'''
+        data = stack.astype(workingType(stack.dtype))
+        data[~mask] = np.nan
+        data.sort(axis=0)
+        count = mask.sum(axis=0)
+        lower = _gather(data, np.maximum(count - 1, 0) // 2)
+        upper = _gather(data, count // 2)
+        return (lower + upper) / 2.0
+
+    def workingMemory(self, shape, dtype):
+        return (shape[0] + 4) * shape[1] * shape[2] * workingType(dtype).itemsize
+
 class GeoMedian(MosaicFunction):
 
     name = "GeoMedian"
     bandByBand = False
+    vectorized = True
+    tolerance = 1e-6
+    maxIterations = 500
 
-    def _compute(self, values):
-        return hd.nangeomedian(np.array(values))
+    def _computeArray(self, stack, mask, bandNames=None):
+        return geometricMedian(stack, mask, self.tolerance, self.maxIterations)
+
+    def workingMemory(self, shape, dtype):
+        nBands, nTimes, pixels = shape[0], shape[1], shape[2] * shape[3]
+        return (3 * nBands * nTimes + 4 * nTimes) * pixels * workingType(dtype).itemsize
+
+class TemporalStatistics(MosaicFunction):
+
+    '''
+    Computes several statistics of the valid values of each pixel: mean, standard
+    deviation, minimum, maximum and the passed percentiles. Values are sorted once, and
+    all statistics are taken from the sorted stack. Each statistic is written as a
+    separate band, and the number of valid values replaces the QA band.
+
+    Without percentiles, values don't have to be sorted, and statistics are computed
+    by folding the values of each date into running sums (using Welford's algorithm
+    for the variance), so the stack of all dates doesn't have to be in memory
+    '''
+
+    name = "Temporal statistics"
+    vectorized = True
+    countOutput = True
+    statistics = ["mean", "std", "min", "max"]
+
+    def __init__(self, percentiles=None):
+        self.percentiles = list(percentiles or [])
+
+    @property
+    def streaming(self):
+        return not self.percentiles
+
+    def statisticNames(self):
+        return self.statistics + ["p%g" % p for p in self.percentiles]
+
+    def outputBands(self, bandName):
+        return ["%s_%s" % (bandName, s) for s in self.statisticNames()]
+
+    def outputType(self, dtype):
+        return workingType(dtype)
+
+    def _computeArray(self, stack, mask):
+        data = stack.astype(workingType(stack.dtype))
+        data[~mask] = np.nan
+        data.sort(axis=0)
+        count = mask.sum(axis=0)
+        n = np.maximum(count, 1).astype(data.dtype)
+        last = np.maximum(count - 1, 0)
+        mean = np.nansum(data, axis=0) / n
+        std = np.sqrt(np.nansum((data - mean) ** 2, axis=0) / n)
+        results = [mean, std, data[0], _gather(data, last)]
+        for p in self.percentiles:
+            '''Linear interpolation between the closest ranks, as np.percentile does'''
+            position = last * (p / 100.0)
+            lower = np.floor(position).astype(int)
+            fraction = (position - lower).astype(data.dtype)
+            lowerValue = _gather(data, lower)
+            upperValue = _gather(data, np.minimum(lower + 1, last))
+            results.append(lowerValue + (upperValue - lowerValue) * fraction)
+        return np.array(results, dtype=data.dtype)
+
+    def _startState(self, shape, dtype):
+        if dtype.kind == "f":
+            lowest, highest = -np.inf, np.inf
+        else:
+            lowest, highest = np.iinfo(dtype).min, np.iinfo(dtype).max
+        return {"count": np.zeros(shape, dtype=np.int32), "mean": np.zeros(shape),
+                "m2": np.zeros(shape), "min": np.full(shape, highest, dtype=dtype),
+                "max": np.full(shape, lowest, dtype=dtype)}
+
+    def _accumulate(self, state, values, valid):
+        state["count"] += valid
+        x = values[valid]
+        count = state["count"][valid]
+        mean = state["mean"][valid]
+        delta = x - mean
+        mean += delta / count
+        state["m2"][valid] += delta * (x - mean)
+        state["mean"][valid] = mean
+        state["min"][valid] = np.minimum(state["min"][valid], x)
+        state["max"][valid] = np.maximum(state["max"][valid], x)
+
+    def _stateResult(self, state):
+        n = np.maximum(state["count"], 1)
+        return np.array([state["mean"], np.sqrt(state["m2"] / n), state["min"], state["max"]],
+                        dtype=workingType(state["min"].dtype))
+
+    def workingMemory(self, shape, dtype):
+        nStats = len(self.statisticNames())
+        return (shape[0] + nStats + 4) * shape[1] * shape[2] * workingType(dtype).itemsize
+
+class BestPixel(MosaicFunction):
+
+    '''
+    Base class for functions that take all the bands of the observation that
+    maximizes a score for each pixel. Subclasses implement _score, which returns a
+    (time, y, x) score for a (bands, time, y, x) stack, with NaN where it cannot be
+    computed. Valid observations with no score are only taken if no observation of
+    that pixel has one
+    '''
+
+    bandByBand = False
+    vectorized = True
+
+    def _computeArray(self, stack, mask, bandNames=None):
+        score = np.asarray(self._score(stack, mask, bandNames), dtype=np.float32)
+        score[np.isnan(score)] = np.finfo(np.float32).min
+        score[~mask] = -np.inf
+        best = np.argmax(score, axis=0)
+        return [_gather(band, best) for band in stack]
+
+    def workingMemory(self, shape, dtype):
+        nBands, nTimes, pixels = shape[0], shape[1], shape[2] * shape[3]
+        return (3 * nTimes + nBands) * pixels * 4
+
+class MaxIndex(BestPixel):
+
+    '''Takes the observation with the highest value of a parameter from plotparams,
+    such as NDVI for greenest pixel composites'''
+
+    streaming = True
+
+    def __init__(self, index):
+        self.index = index
+        self.name = "Max %s" % index.name
+
+    def canBeComputed(self, bandNames):
+        return self.index.canBeComputed(bandNames)
+
+    def _score(self, stack, mask, bandNames):
+        return self.index.array(stack, bandNames)
+
+    def _startState(self, shape, dtype):
+        return {"score": np.full(shape[1:], -np.inf, dtype=np.float32), "values": np.zeros(shape, dtype=dtype)}
+
+    def _accumulate(self, state, values, valid, bandNames):
+        '''Only strictly better scores replace the current ones, so ties are solved
+        as argmax does in _computeArray'''
+        score = np.asarray(self.index.array(values, bandNames), dtype=np.float32)
+        score[np.isnan(score)] = np.finfo(np.float32).min
+        better = valid & (score > state["score"])
+        state["score"][better] = score[better]
+        state["values"][:, better] = values[:, better]
+
+    def _stateResult(self, state):
+        return list(state["values"])
+
+class Medoid(BestPixel):
+
+    '''Takes the observation with the lowest sum of (euclidean) distances, across all bands,
+    to the other valid observations of the pixel'''
+
+    name = "Medoid"
+
+    def _score(self, stack, mask, bandNames=None):
+        X = stack.astype(workingType(stack.dtype))
+        cost = np.zeros(mask.shape, dtype=X.dtype)
+        for i in xrange(X.shape[1]):
+            distance = np.sqrt(((X - X[:, i:i + 1]) ** 2).sum(axis=0))
+            distance[~mask] = 0
+            cost[i] = distance.sum(axis=0)
+        return -cost
+
+    def workingMemory(self, shape, dtype):
+        nBands, nTimes, pixels = shape[0], shape[1], shape[2] * shape[3]
+        return (2 * nBands * nTimes + 5 * nTimes) * pixels * workingType(dtype).itemsize
+
+class WaterFrequency(MosaicFunction):
+
+    '''
+    Classifies each valid observation as water or not with the WOFS decision tree, and
+    computes the fraction of them that are water for each pixel. The result is a single
+    band, written in the place of the blue band, and the number of valid observations
+    replaces the QA band
+    '''
+
+    name = "Water frequency"
+    bandByBand = False
+    vectorized = True
+    streaming = True
+    countOutput = True
+
+    def __init__(self):
+        self.classifier = WOFS()
+
+    def canBeComputed(self, bandNames):
+        return self.classifier.canBeComputed(bandNames)
+
+    def outputBands(self, bandName):
+        return ["water_frequency"] if bandName == "blue" else []
+
+    def outputType(self, dtype):
+        return np.dtype(np.float32)
+
+    def _frequency(self, water, observed):
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return [(water / observed.astype(np.float32)).astype(np.float32)]
+
+    def _computeArray(self, stack, mask, bandNames=None):
+        water = self.classifier.array(stack, bandNames)
+        observed = mask & ~np.isnan(water)
+        return self._frequency((observed & (water == 1)).sum(axis=0), observed.sum(axis=0))
+
+    def workingMemory(self, shape, dtype):
+        nTimes, pixels = shape[1], shape[2] * shape[3]
+        return 8 * 12 * nTimes * pixels
+
+    def _startState(self, shape, dtype):
+        return {"water": np.zeros(shape[1:], dtype=np.int32), "observed": np.zeros(shape[1:], dtype=np.int32)}
+
+    def _accumulate(self, state, values, valid, bandNames):
+        water = self.classifier.array(values, bandNames)
+        observed = valid & ~np.isnan(water)
+        state["observed"] += observed
+        state["water"] += observed & (water == 1)
+
+    def _stateResult(self, state):
+        return self._frequency(state["water"], state["observed"])
+
+class MeanFractionalCover(MosaicFunction):
+
+    '''
+    Computes the fractional cover of bare soil, photosynthetic vegetation and non
+    photosynthetic vegetation of each valid observation, and the mean of each of them
+    for each pixel. Observations are unmixed one date at a time, with all their valid
+    pixels at once. The three fractions are written in the place of the blue band, and
+    the number of valid observations replaces the QA band
+    '''
+
+    name = "Mean fractional cover"
+    bandByBand = False
+    vectorized = True
+    streaming = True
+    countOutput = True
+
+    def canBeComputed(self, bandNames):
+        return all(b in bandNames for b in FRACTIONAL_COVER_BANDS)
+
+    def outputBands(self, bandName):
+        return ["bs", "pv", "npv"] if bandName == "blue" else []
+
+    def outputType(self, dtype):
+        return np.dtype(np.float32)
+
+    def _computeArray(self, stack, mask, bandNames=None):
+        state = self._startState(stack.shape[:1] + stack.shape[2:], stack.dtype)
+        for t in xrange(stack.shape[1]):
+            self._accumulate(state, stack[:, t], mask[t], bandNames)
+        return self._stateResult(state)
+
+    def workingMemory(self, shape, dtype):
+        return 3 * 64 * 8 * shape[2] * shape[3]
+
+    def _startState(self, shape, dtype):
+        return {"sum": np.zeros((3,) + shape[1:]), "observed": np.zeros(shape[1:], dtype=np.int32)}
+
+    def _accumulate(self, state, values, valid, bandNames):
+        fractions = np.array(fractionalCover(values[:, valid], bandNames))
+        observed = ~np.isnan(fractions).any(axis=0)
+        rows, cols = np.nonzero(valid)
+        rows, cols = rows[observed], cols[observed]
+        state["sum"][:, rows, cols] += fractions[:, observed]
+        state["observed"][rows, cols] += 1
+
+    def _stateResult(self, state):
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return list((state["sum"] / state["observed"]).astype(np.float32))
 
-mosaicFunctions = [MostRecent(), LeastRecent(), Median()]
-if geoMedianOk:
-    mosaicFunctions.append(GeoMedian())
+mosaicFunctions = [MostRecent(), LeastRecent(), Median(), GeoMedian(), TemporalStatistics([10, 50, 90]),
+                   MaxIndex(NDVI()), MaxIndex(NDWI()), Medoid(), WaterFrequency(), MeanFractionalCover()]
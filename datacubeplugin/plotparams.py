@@ -1,8 +1,11 @@
-from qgis.core import QgsRaster, QgsRasterBlock
 import numpy as np
 import os
+import itertools
 
 def getBand(layer, pt, band, bands):
+    '''QGIS is imported here, so parameters can compute arrays in processes
+    that have no QGIS (such as those computing mosaics)'''
+    from qgis.core import QgsRaster
     try:
         idx = bands.index(band)
     except ValueError:
@@ -39,8 +42,27 @@ def getSWIR2(layer, pt, bands):
 def getPixelQA(layer, pt, bands):
     return getBand(layer, pt, "pixel_qa", bands)
 
+def getBandArray(values, band, bands, dtype=np.float32):
+    '''Returns the values of a band as a float32 array, or an array of the passed
+    type, given a sequence with the values of all the bands, in the same order as
+    the list of band names'''
+    return np.asarray(values[bands.index(band)], dtype=dtype)
+
+def ratio(a, b):
+    '''a / b, with NaN where b is zero'''
+    with np.errstate(divide="ignore", invalid="ignore"):
+        result = np.asarray(a / b)
+    result[b == 0] = np.nan
+    return result
+
+def normalizedDifference(a, b):
+    '''(a - b) / (a + b), with NaN where a + b is zero'''
+    return ratio(a - b, a + b)
+
 class PlotParameter():
 
+    qaMask = None
+
     def __str__(self):
         return self.name
 
@@ -58,9 +80,26 @@ class PlotParameter():
             return None
 
     def checkMask(self, layer, pt, bands):
-        return True
-        v = getPixelQA(layer, pt, bands)
-        return v is None or v not in [66, 68, 130, 132]
+        if self.qaMask is None:
+            return True
+        return self.qaMask.isValid(getPixelQA(layer, pt, bands))
+
+    def array(self, values, bands):
+        '''
+        Computes the parameter for arrays of values. values is a sequence with an array
+        for each band, in the same order as the list of band names, and all of them
+        with the same shape, which is also the shape of the result. The result is NaN
+        where the parameter cannot be computed. The QA mask is not applied
+        '''
+        raise NotImplementedError()
+
+    def maskedArray(self, values, bands):
+        '''Like array, but with NaN where the QA mask marks values as invalid, as
+        value does for a single pixel'''
+        result = self.array(values, bands)
+        if self.qaMask is not None and "pixel_qa" in bands:
+            result[~self.qaMask.validMask(np.asarray(values[bands.index("pixel_qa")]))] = np.nan
+        return result
 
 class BandValue(PlotParameter):
 
@@ -71,6 +110,10 @@ class BandValue(PlotParameter):
     def _value(self, layer, pt, bands):
         return getBand(layer, pt, self.name, bands)
 
+    def array(self, values, bands):
+        '''The values are copied, since the result is modified when masking it'''
+        return np.array(values[bands.index(self.name)], dtype=np.float32)
+
 
 class NDVI(PlotParameter):
 
@@ -82,7 +125,10 @@ class NDVI(PlotParameter):
         nir = getNIR(layer, pt, bands)
         if nir is None or r is None:
             return None
-        return float(r - nir)/ float(r + nir)
+        return float(nir - r)/ float(nir + r)
+
+    def array(self, values, bands):
+        return normalizedDifference(getBandArray(values, "nir", bands), getBandArray(values, "red", bands))
 
 class EVI(PlotParameter):
 
@@ -99,7 +145,17 @@ class EVI(PlotParameter):
         b = getB(layer, pt, bands)
         if nir is None or r is None or b is None:
             return None
-        return G * float(nir- r)/ float(nir + C1 * r - C2 + b + L)
+        return G * float(nir- r)/ float(nir + C1 * r - C2 * b + L)
+
+    def array(self, values, bands):
+        L=1
+        C1 = 6
+        C2 = 7.5
+        G = 2.5
+        r = getBandArray(values, "red", bands)
+        nir = getBandArray(values, "nir", bands)
+        b = getBandArray(values, "blue", bands)
+        return G * ratio(nir - r, nir + C1 * r - C2 * b + L)
 
 class NDWI(PlotParameter):
 
@@ -113,6 +169,9 @@ class NDWI(PlotParameter):
             return None
         return float(g - nir)/ float(g + nir)
 
+    def array(self, values, bands):
+        return normalizedDifference(getBandArray(values, "green", bands), getBandArray(values, "nir", bands))
+
 class NDBI(PlotParameter):
 
     name = "NDBI"
@@ -125,6 +184,9 @@ class NDBI(PlotParameter):
             return None
         return float(nir - swir)/ float(nir + swir)
 
+    def array(self, values, bands):
+        return normalizedDifference(getBandArray(values, "nir", bands), getBandArray(values, "swir1", bands))
+
 class WOFS(PlotParameter):
 
     name = "WOFS"
@@ -240,6 +302,69 @@ class WOFS(PlotParameter):
                 else:
                     return 0  #Node 36
 
+    def array(self, values, bands):
+        '''Evaluates the decision tree for all pixels at once. Each leaf of the tree
+        is the conjunction of the conditions on its path, and leaves are assigned with
+        np.select. Values are converted to float64, so band ratios and comparisons with
+        the thresholds are the same as in _value'''
+        band1, band2, band3, band4, band5, band7 = [getBandArray(values, b, bands, np.float64) for b in
+                                                    ["blue", "green", "red", "nir", "swir1", "swir2"]]
+
+        ndi_52 = normalizedDifference(band5, band2)
+        ndi_43 = normalizedDifference(band4, band3)
+        ndi_72 = normalizedDifference(band7, band2)
+
+        with np.errstate(invalid="ignore"):
+            r1 = ndi_52 <= -0.01
+            r2 = band1 <= 2083.5
+            r3 = band7 <= 323.5
+            r4 = ndi_43 <= 0.61
+            r5 = band1 <= 1400.5
+            r6 = ndi_43 <= -0.01
+            r7 = ndi_72 <= -0.23
+            r8 = band1 <= 379
+            r9 = ndi_43 <= 0.22
+            r10 = band1 <= 473
+            r11 = ndi_52 <= 0.23
+            r12 = band1 <= 334.5
+            r13 = ndi_43 <= 0.54
+            r14 = ndi_52 <= 0.12
+            r15 = band3 <= 364.5
+            r16 = band1 <= 129.5
+            r17 = band1 <= 300.5
+            r18 = ndi_52 <= 0.34
+            r19 = band1 <= 249.5
+            r20 = ndi_43 <= 0.45
+            r21 = band3 <= 364.5
+            r22 = band1 <= 129.5
+
+        leaves = [(r1 & ~r2, 0), #Node 3
+                  (r1 & r2 & r3 & r4, 1), #Node 6
+                  (r1 & r2 & r3 & ~r4, 0), #Node 7
+                  (r1 & r2 & ~r3 & ~r5 & r6, 1), #Node 10
+                  (r1 & r2 & ~r3 & ~r5 & ~r6, 0), #Node 11
+                  (r1 & r2 & ~r3 & r5 & r7 & r9, 1), #Node 17
+                  (r1 & r2 & ~r3 & r5 & r7 & ~r9 & r10, 1), #Node 19
+                  (r1 & r2 & ~r3 & r5 & r7 & ~r9 & ~r10, 0), #Node 20
+                  (r1 & r2 & ~r3 & r5 & ~r7 & r8, 1), #Node 14
+                  (r1 & r2 & ~r3 & r5 & ~r7 & ~r8, 0), #Node 15
+                  (~r1 & r11 & r12 & r13 & r14, 1), #Node 27
+                  (~r1 & r11 & r12 & r13 & ~r14 & r15 & r16, 1), #Node 31
+                  (~r1 & r11 & r12 & r13 & ~r14 & r15 & ~r16, 0), #Node 32
+                  (~r1 & r11 & r12 & r13 & ~r14 & ~r15 & r17, 1), #Node 33
+                  (~r1 & r11 & r12 & r13 & ~r14 & ~r15 & ~r17, 0), #Node 34
+                  (~r1 & r11 & r12 & ~r13, 0), #Node 25
+                  (~r1 & r11 & ~r12, 0), #Node 23
+                  (~r1 & ~r11 & r18 & r19 & r20 & r21 & r22, 1), #Node 44
+                  (~r1 & ~r11 & r18 & r19 & r20 & r21 & ~r22, 0), #Node 45
+                  (~r1 & ~r11 & r18 & r19 & r20 & ~r21, 0), #Node 42
+                  (~r1 & ~r11 & r18 & r19 & ~r20, 0), #Node 40
+                  (~r1 & ~r11 & r18 & ~r19, 0), #Node 38
+                  (~r1 & ~r11 & ~r18, 0)] #Node 36
+        result = np.select([c for c, v in leaves], [v for c, v in leaves], np.nan).astype(np.float32)
+        result[np.isnan(ndi_52) | np.isnan(ndi_43) | np.isnan(ndi_72)] = np.nan
+        return result
+
 
 
 class TSM(PlotParameter):
@@ -256,102 +381,144 @@ class TSM(PlotParameter):
         tsm = 3983 * tsmi**1.6246
         return tsm
 
-#csvFilepath = os.path.join(os.path.dirname(__file__), 'data', 'endmembers_landsat.csv')
-
-#_endMembers = np.loadtxt(csvFilepath, delimiter=',')  # Creates a 64 x 3 matrix
-
-def fractionalCover(layer, pt, bands):
-
-    b = getB(layer, pt, bands)
-    g = getG(layer, pt, bands)
-    r = getR(layer, pt, bands)
-    nir = getNIR(layer, pt, bands)
-    swir1 = getSWIR1(layer, pt, bands)
-    swir2 = getSWIR2(layer, pt, bands)
-
-    if None in [r, g, b, nir, swir1, swir2]:
-        return None
-
-    endMembers = np.copy(_endMembers)
-
-    band_stack = np.array([[b], [g], [r],[nir],[swir1][swir2]]).transpose()
-
-    for band in range(6):
-        band_stack = np.hstack((band_stack, np.expand_dims(np.log(band_stack[:, band]), axis=1)))
-    for band in range(6):
-        band_stack = np.hstack(
-            (band_stack, np.expand_dims(np.multiply(band_stack[:, band], band_stack[:, band + 6]), axis=1)))
-    for band in range(6):
-        for b2 in range(band + 1, 6):
-            band_stack = np.hstack(
-                (band_stack, np.expand_dims(np.multiply(band_stack[:, band], band_stack[:, b2]), axis=1)))
-    for band in range(6):
-        for b2 in range(band + 1, 6):
-            band_stack = np.hstack(
-                (band_stack, np.expand_dims(np.multiply(band_stack[:, band + 6], band_stack[:, b2 + 6]), axis=1)))
-    for band in range(6):
-        for b2 in range(band + 1, 6):
-            band_stack = np.hstack((band_stack, np.expand_dims(
-                np.divide(band_stack[:, b2] - band_stack[:, band], band_stack[:, b2] + band_stack[:, band]), axis=1)))
-
-    band_stack = np.nan_to_num(band_stack)  # Now a n x 63 matrix (assuming one acquisition)
-
-    ones = np.ones(band_stack.shape[0])
-    ones = ones.reshape(ones.shape[0], 1)
-    band_stack = np.concatenate((band_stack, ones), axis=1)  # Now a n x 64 matrix (assuming one acquisition)
-
-    SumToOneWeight = 0.02
-    ones = np.ones(endMembers.shape[1]) * SumToOneWeight
-    ones = ones.reshape(1, endMembers.shape[1])
-    end_members = np.concatenate((endMembers, ones), axis=0).astype(np.float32)
-
-    result = np.zeros((band_stack.shape[0], end_members.shape[1]), dtype=np.float32)  # Creates an n x 3 matrix
+    def array(self, values, bands):
+        g = getBandArray(values, "green", bands)
+        r = getBandArray(values, "red", bands)
+        tsmi = (r + g) * 0.0001 / 2
+        with np.errstate(invalid="ignore"):
+            return 3983 * tsmi**1.6246
+
+FRACTIONAL_COVER_BANDS = ["blue", "green", "red", "nir", "swir1", "swir2"]
+SUM_TO_ONE_WEIGHT = 0.02
+REFLECTANCE_SCALE = 0.0001
+
+_unmixingModel = None
+
+def unmixingModel():
+    '''
+    Returns the end members used to compute the fractional cover, as a (64, 3) matrix
+    with the 63 features of the PV, NPV and BS end members and a last row that weights
+    the sum-to-one constraint, along with the factorizations used by nnls to solve
+    problems with that matrix. They are loaded and computed only once
+    '''
+    global _unmixingModel
+    if _unmixingModel is None:
+        csvFilepath = os.path.join(os.path.dirname(__file__), 'data', 'endmembers_landsat.csv')
+        endMembers = np.loadtxt(csvFilepath, delimiter=',')
+        ones = np.ones((1, endMembers.shape[1])) * SUM_TO_ONE_WEIGHT
+        endMembers = np.concatenate((endMembers, ones), axis=0)
+        _unmixingModel = endMembers, nnlsFactorizations(endMembers)
+    return _unmixingModel
+
+def nnlsFactorizations(A):
+    '''Returns the pseudo-inverse of the submatrix of A with each non-empty subset of
+    its columns, as a list of (columns, pseudo-inverse) tuples'''
+    n = A.shape[1]
+    subsets = [list(s) for k in xrange(1, n + 1) for s in itertools.combinations(range(n), k)]
+    return [(s, np.linalg.pinv(A[:, s])) for s in subsets]
+
+def nnls(A, B, factorizations=None):
+    '''
+    Solves min ||Ax - b|| subject to x >= 0 for all the columns b of the (m, n) matrix B
+    at once, and returns the (A columns, n) matrix with the solutions.
+
+    The solution has some set of positive components and the rest are zero, and it is the
+    unconstrained least squares solution using only the columns of A in that set. So the
+    solution is the one with the smallest residual among the non-negative least squares
+    solutions of each subset of columns, which are computed for all problems at once
+    with the precomputed pseudo-inverses of those subsets. The number of subsets grows
+    exponentially with the number of columns of A, so this is only suitable for small
+    numbers of them, such as the end members of the fractional cover
+    '''
+    factorizations = factorizations or nnlsFactorizations(A)
+    B = np.asarray(B, dtype=np.float64)
+    solution = np.zeros((A.shape[1], B.shape[1]))
+    residual = (B ** 2).sum(axis=0)
+    for columns, pinv in factorizations:
+        x = pinv.dot(B)
+        feasible = np.nonzero((x >= 0).all(axis=0))[0]
+        x = x[:, feasible]
+        subsetResidual = ((A[:, columns].dot(x) - B[:, feasible]) ** 2).sum(axis=0)
+        better = subsetResidual < residual[feasible]
+        idx = feasible[better]
+        solution[:, idx] = 0
+        solution[np.array(columns)[:, np.newaxis], idx] = x[:, better]
+        residual[idx] = subsetResidual[better]
+    return solution
+
+def unmixingFeatures(reflectance):
+    '''
+    Returns the (64, pixels) matrix with the features used to unmix a (6, pixels) array
+    with the reflectance (between 0 and 1) of the FRACTIONAL_COVER_BANDS: the reflectance,
+    its logarithm, their product, the products of each pair of bands and of their
+    logarithms, the normalized differences of each pair of bands, and the weight of the
+    sum-to-one constraint. Features that cannot be computed are set to zero
+    '''
+    pairs = list(itertools.combinations(range(len(reflectance)), 2))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        logs = np.log(reflectance)
+        features = np.concatenate([reflectance, logs, reflectance * logs,
+                                   [reflectance[i] * reflectance[j] for i, j in pairs],
+                                   [logs[i] * logs[j] for i, j in pairs],
+                                   [(reflectance[j] - reflectance[i]) / (reflectance[j] + reflectance[i]) for i, j in pairs],
+                                   np.ones((1, reflectance.shape[1])) * SUM_TO_ONE_WEIGHT])
+    features[~np.isfinite(features)] = 0
+    return features
+
+def fractionalCover(values, bands):
+    '''
+    Computes the fractional cover of bare soil, photosynthetic vegetation and non
+    photosynthetic vegetation, as percentages, for arrays of values. values is a sequence
+    with an array for each band, in the same order as the list of band names, with
+    surface reflectance scaled by 10000. Returns a (bs, pv, npv) tuple of float32 arrays
+    with the shape of the bands, with NaN where any band is not positive. All pixels
+    are unmixed at once
+    '''
+    endMembers, factorizations = unmixingModel()
+    reflectance = np.array([getBandArray(values, b, bands, np.float64) for b in FRACTIONAL_COVER_BANDS])
+    shape = reflectance.shape[1:]
+    reflectance = reflectance.reshape(len(FRACTIONAL_COVER_BANDS), -1) * REFLECTANCE_SCALE
+    fractions = nnls(endMembers, unmixingFeatures(reflectance), factorizations)
+    fractions = (fractions.clip(0, 2.54) * 100).astype(np.float32)
+    fractions[:, (reflectance <= 0).any(axis=0)] = np.nan
+    pv, npv, bs = fractions.reshape((3,) + shape)
+    return bs, pv, npv
 
-    for i in range(band_stack.shape[0]):
-        result[i, :] = (opt.nnls(end_members, band_stack[i, :])[0].clip(0, 2.54) * 100).astype(np.int16)
+class FractionalCoverParameter(PlotParameter):
 
-    pv = result[:, :, 0]
-    npv = result[:, :, 1]
-    bs = result[:, :, 2]
-
-    return bs, pv, npv
+    requiredBands = FRACTIONAL_COVER_BANDS
 
+    def _value(self, layer, pt, bands):
+        values = [getBand(layer, pt, b, bands) for b in FRACTIONAL_COVER_BANDS]
+        if None in values:
+            return None
+        value = self.array([np.array([v]) for v in values], FRACTIONAL_COVER_BANDS)[0]
+        return None if np.isnan(value) else float(value)
 
+    def array(self, values, bands):
+        return fractionalCover(values, bands)[self.fraction]
 
-class BS(PlotParameter):
+class BS(FractionalCoverParameter):
 
     name = "BS"
+    fraction = 0
 
-    def _value(self, layer, pt, bands):
-        fc = fractionalCover(layer, pt, bands)
-        if fc is None:
-            return None
-        return fc[0]
-
-class PV(PlotParameter):
+class PV(FractionalCoverParameter):
 
     name = "PV"
+    fraction = 1
 
-    def _value(self, layer, pt, bands):
-        fc = fractionalCover(layer, pt, bands)
-        if fc is None:
-            return None
-        return fc[1]
-
-class NPV(PlotParameter):
+class NPV(FractionalCoverParameter):
 
     name = "NPV"
+    fraction = 2
 
-    def _value(self, layer, pt, bands):
-        fc = fractionalCover(layer, pt, bands)
-        if fc is None:
-            return None
-        return fc[2]
-
-def getParameters(bands):
-    indices = [NDVI(), NDBI(), EVI(), NDWI(), WOFS(), TSM()]
+def getParameters(bands, qaMask=None):
+    indices = [NDVI(), NDBI(), EVI(), NDWI(), WOFS(), TSM(), BS(), PV(), NPV()]
     blacklisted = ["coastal_aerosol", "aerosol_qa", "radsat_qa", "solar_azimuth",
                    "solar_zenith", "sensor_azimuth", "sensor_zenith"]
     parameters = [BandValue(b) for b in bands if b not in blacklisted]
     parameters.extend([ind for ind in indices if ind.canBeComputed(bands)])
+    for p in parameters:
+        p.qaMask = qaMask
     return parameters
\ No newline at end of file
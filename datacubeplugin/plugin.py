@@ -68,7 +68,7 @@ class DataCubePlugin:
         self.mosaicAction.setText("Mosaic tool")
         self.iface.addPluginToMenu("Data Cube Plugin", self.mosaicAction)
 
-        #addSettingsMenu("Data Cube Plugin")
+        addSettingsMenu("Data Cube Plugin")
         addHelpMenu("Data Cube Plugin")
         addAboutMenu("Data Cube Plugin")
 
@@ -89,7 +89,7 @@ class DataCubePlugin:
 
         self.iface.removePluginMenu("Data Cube Plugin", self.dataCubeAction)
         self.iface.removePluginMenu("Data Cube Plugin", self.mosaicAction)
-        #removeSettingsMenu("Data Cube Plugin")
+        removeSettingsMenu("Data Cube Plugin")
         removeAboutMenu("Data Cube Plugin")
         removeHelpMenu("Data Cube Plugin")
 
@@ -0,0 +1,76 @@
+import json
+import numpy as np
+
+#Bits of the Landsat surface reflectance pixel_qa band
+FILL = 0
+CLEAR = 1
+WATER = 2
+CLOUD_SHADOW = 3
+SNOW = 4
+CLOUD = 5
+
+BITS = {"fill": FILL, "clear": CLEAR, "water": WATER,
+        "cloud_shadow": CLOUD_SHADOW, "snow": SNOW, "cloud": CLOUD}
+
+#Predefined rules that can be used by name. "cfmask" uses the values of the CFMask
+#band (2=cloud shadow, 4=cloud, 255=fill), and the "pixel_qa" ones the bits of the pixel_qa band
+RULES = {"cfmask": {"invalidValues": [2, 4, 255]},
+         "pixel_qa": {"invalidBits": ["fill", "cloud_shadow", "cloud"]},
+         "pixel_qa_snow": {"invalidBits": ["fill", "cloud_shadow", "snow", "cloud"]}}
+
+DEFAULT_RULE = "cfmask"
+
+class QAMask():
+
+    '''
+    Decides which pixels are valid according to the value of a QA band.
+    A pixel is invalid if its QA value is one of the invalid values, or
+    if it has any of the invalid bits set
+    '''
+
+    def __init__(self, invalidValues=None, invalidBits=None):
+        self.invalidValues = list(invalidValues or [])
+        self.invalidBits = 0
+        for bit in invalidBits or []:
+            index = BITS.get(bit, bit)
+            if not isinstance(index, (int, long)) or not 0 <= index < 16:
+                raise ValueError("Wrong QA bit: %s" % bit)
+            self.invalidBits |= 1 << index
+        self._lut = None
+
+    def isValid(self, v):
+        if v is None:
+            return True
+        v = int(v)
+        return v not in self.invalidValues and not v & self.invalidBits
+
+    def lookupTable(self):
+        if self._lut is None:
+            codes = np.arange(65536)
+            self._lut = (codes & self.invalidBits) == 0
+            self._lut &= ~np.in1d(codes, self.invalidValues)
+        return self._lut
+
+    def validMask(self, qa):
+        '''Returns a boolean array with the shape of qa, that can be a single
+        array or a list of them, telling which pixels are valid'''
+        qa = np.asarray(qa)
+        if qa.dtype in (np.uint8, np.uint16):
+            return self.lookupTable()[qa]
+        valid = ~np.in1d(qa.ravel(), self.invalidValues).reshape(qa.shape)
+        if self.invalidBits:
+            valid &= (qa.astype(np.int64) & self.invalidBits) == 0
+        return valid
+
+
+def qaMaskFromRule(rule):
+    '''Creates a QAMask from the name of a predefined rule, a JSON string
+    or a dict with "invalidValues" and/or "invalidBits" entries. Raises ValueError
+    if the rule is not valid'''
+    rule = rule or DEFAULT_RULE
+    if isinstance(rule, basestring):
+        rule = rule.strip()
+        rule = RULES[rule] if rule in RULES else json.loads(rule)
+    if not isinstance(rule, dict):
+        raise ValueError("QA rule must be a rule name or a JSON object")
+    return QAMask(rule.get("invalidValues"), rule.get("invalidBits"))
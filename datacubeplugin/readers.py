@@ -0,0 +1,90 @@
+import threading
+from collections import OrderedDict
+import numpy as np
+from osgeo import gdal, gdal_array
+from osgeo.gdalconst import GA_ReadOnly
+
+class DatasetPool():
+
+    '''
+    Keeps the most recently used GDAL datasets open, so reading several bands or
+    windows of the same file doesn't require opening it and parsing its header
+    every time. Datasets are not shared between threads, so each thread has its
+    own set of open datasets
+    '''
+
+    def __init__(self, maxSize=64):
+        self.maxSize = maxSize
+        self._local = threading.local()
+
+    def _datasets(self):
+        try:
+            return self._local.datasets
+        except AttributeError:
+            self._local.datasets = OrderedDict()
+            return self._local.datasets
+
+    def dataset(self, filename):
+        datasets = self._datasets()
+        ds = datasets.pop(filename, None)
+        if ds is None:
+            ds = gdal.Open(filename, GA_ReadOnly)
+            if ds is None:
+                raise IOError("Could not open file %s" % filename)
+            while len(datasets) >= self.maxSize:
+                datasets.popitem(last=False)
+        datasets[filename] = ds
+        return ds
+
+    def close(self, filenames=None):
+        '''Closes the passed files, or all of them if no file is passed. Files
+        should be closed before deleting or modifying them'''
+        datasets = self._datasets()
+        if filenames is None:
+            datasets.clear()
+        else:
+            for filename in filenames:
+                datasets.pop(filename, None)
+
+    def readBands(self, filename, bands=None, out=None, window=None):
+        '''
+        Reads the passed bands (1-based indices, all bands if None) of a file into
+        a (bands, y, x) array, using a single call to GDAL. If out is passed, data is
+        written to it instead of creating a new array. Window is an optional
+        (xoff, yoff, width, height) tuple
+        '''
+        ds = self.dataset(filename)
+        bands = list(bands or range(1, ds.RasterCount + 1))
+        xoff, yoff, width, height = window or (0, 0, ds.RasterXSize, ds.RasterYSize)
+        if out is None:
+            dtype = gdal_array.GDALTypeCodeToNumericTypeCode(ds.GetRasterBand(bands[0]).DataType)
+            out = np.empty((len(bands), height, width), dtype=dtype)
+        if bands == list(range(1, ds.RasterCount + 1)):
+            result = ds.ReadAsArray(xoff, yoff, width, height, buf_obj=out)
+        else:
+            try:
+                result = ds.ReadAsArray(xoff, yoff, width, height, buf_obj=out, band_list=bands)
+            except TypeError:
+                '''band_list is not supported by older GDAL versions'''
+                for i, band in enumerate(bands):
+                    result = ds.GetRasterBand(band).ReadAsArray(xoff, yoff, width, height, buf_obj=out[i])
+                    if result is None:
+                        break
+        '''GDAL returns None if the data cannot be read, leaving the buffer unfilled'''
+        if result is None:
+            raise IOError("Could not read data from file %s" % filename)
+        return out
+
+    def readStack(self, filenames, bands):
+        '''Reads the passed bands of a list of files with the same size and data type
+        into a (files, bands, y, x) array. Stacks are usually read band by band, so the
+        pool grows to keep all their files open'''
+        self.maxSize = max(self.maxSize, len(filenames))
+        ds = self.dataset(filenames[0])
+        dtype = gdal_array.GDALTypeCodeToNumericTypeCode(ds.GetRasterBand(bands[0]).DataType)
+        stack = np.empty((len(filenames), len(bands), ds.RasterYSize, ds.RasterXSize), dtype=dtype)
+        for i, filename in enumerate(filenames):
+            self.readBands(filename, bands, out=stack[i])
+        return stack
+
+datasets = DatasetPool()
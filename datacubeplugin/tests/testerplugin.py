@@ -2,7 +2,10 @@
 # https://github.com/boundlessgeo/qgis-tester-plugin
 
 import os
+import shutil
+import tempfile
 import unittest
+import numpy as np
 from qgis.PyQt.QtGui import QApplication
 try:
     from qgistester.test import Test
@@ -73,9 +76,504 @@ def functionalTests():
 
 class DataCubePluginTest(unittest.TestCase):
 
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder, ignore_errors=True)
+
     def testSampleTest(self):
         pass
 
+    def _randomStack(self, times=6, height=9, width=11):
+        rng = np.random.RandomState(0)
+        values = [rng.randint(-500, 5000, (height, width)).astype(np.int16) for _ in range(times)]
+        qa = [rng.choice([0, 1, 2, 3, 4, 255], (height, width)).astype(np.uint8) for _ in range(times)]
+        return values, qa
+
+    def testVectorizedMosaicFunctions(self):
+        from datacubeplugin.mosaicfunctions import MostRecent, LeastRecent, Median, noDataValue
+        from datacubeplugin.qamasks import qaMaskFromRule
+        values, qa = self._randomStack()
+        mask = qaMaskFromRule("cfmask").validMask(qa)
+        valid = mask.any(axis=0)
+        for func in [MostRecent(), LeastRecent(), Median()]:
+            perPixel = func.__class__()
+            perPixel.vectorized = False
+            result = func.compute(values, mask)
+            self.assertTrue(np.array_equal(result[valid], perPixel.compute(values, mask)[valid]))
+            self.assertTrue(np.all(result[~valid] == noDataValue(result.dtype)))
+            self.assertTrue(np.array_equal(func.compute(values, None), perPixel.compute(values, None)))
+
+    def testMosaicFunctionsKeepSourceType(self):
+        from datacubeplugin.mosaicfunctions import MostRecent, Median, noDataValue
+        values, qa = self._randomStack()
+        mask = np.ones((len(values),) + values[0].shape, dtype=bool)
+        mask[:, 0, 0] = False
+        result = MostRecent().compute(values, mask)
+        self.assertEqual(result.dtype, np.int16)
+        self.assertEqual(result[0, 0], noDataValue(np.int16))
+        self.assertEqual(Median().compute(values, mask).dtype, np.float32)
+        self.assertEqual(noDataValue(np.uint8), 255)
+
+    def testGeoMedianOfSingleBandIsMedian(self):
+        from datacubeplugin.mosaicfunctions import GeoMedian, Median, NO_DATA
+        values, qa = self._randomStack(times=7)
+        mask = np.ones((7,) + values[0].shape, dtype=bool)
+        mask[:, 0, 0] = False
+        geomedian = GeoMedian().compute([values], mask)[0]
+        median = Median().compute(values, mask)
+        self.assertEqual(geomedian[0, 0], NO_DATA)
+        self.assertTrue(np.allclose(geomedian, median, atol=0.01))
+
+    def testTemporalStatistics(self):
+        from datacubeplugin.mosaicfunctions import TemporalStatistics, noDataValue
+        from datacubeplugin.qamasks import qaMaskFromRule
+        values, qa = self._randomStack()
+        mask = qaMaskFromRule("cfmask").validMask(qa)
+        stack = np.array(values)
+        func = TemporalStatistics([10, 50, 75])
+        result = func.compute(values, mask)
+        self.assertEqual(len(result), len(func.outputBands("red")))
+        for y in xrange(stack.shape[1]):
+            for x in xrange(stack.shape[2]):
+                valid = stack[mask[:, y, x], y, x].astype(np.float64)
+                if len(valid):
+                    expected = [valid.mean(), valid.std(), valid.min(), valid.max()]
+                    expected.extend(np.percentile(valid, p) for p in [10, 50, 75])
+                    self.assertTrue(np.allclose(result[:, y, x], expected, rtol=1e-5))
+                else:
+                    self.assertTrue(np.all(result[:, y, x] == noDataValue(result.dtype)))
+
+    def testStreamingMosaicFunctions(self):
+        from datacubeplugin.mosaicfunctions import MostRecent, LeastRecent, TemporalStatistics
+        from datacubeplugin.qamasks import qaMaskFromRule
+        values, qa = self._randomStack()
+        mask = qaMaskFromRule("cfmask").validMask(qa)
+        count = mask.sum(axis=0)
+        for func in [MostRecent(), LeastRecent(), TemporalStatistics()]:
+            self.assertTrue(func.streaming)
+            state = func.startState(values[0].shape, values[0].dtype)
+            for v, valid in zip(values, mask):
+                func.accumulate(state, v, valid)
+            streamed = func.stateResult(state, count)
+            self.assertEqual(streamed.dtype, func.compute(values, mask).dtype)
+            self.assertTrue(np.allclose(streamed, func.compute(values, mask), rtol=1e-5))
+
+    def testComputeByRows(self):
+        from datacubeplugin.mosaic import _computeByRows
+        from datacubeplugin.mosaicfunctions import mosaicFunctions
+        from datacubeplugin.qamasks import qaMaskFromRule
+        bandNames = ["blue", "green", "red", "nir", "swir1", "swir2"]
+        rng = np.random.RandomState(0)
+        stack = rng.randint(1, 5000, (len(bandNames), 6, 9, 11)).astype(np.int16)
+        mask = qaMaskFromRule("cfmask").validMask(self._randomStack()[1])
+        for func in mosaicFunctions:
+            '''A budget of a single byte computes the stack one row at a time'''
+            if func.bandByBand:
+                expected = np.asarray(func.compute(stack[0], mask))
+                result, memory = _computeByRows(func, stack[0], mask, None, 1)
+            else:
+                expected = np.asarray(func.compute(stack, mask, bandNames))
+                result, memory = _computeByRows(func, stack, mask, bandNames, 1)
+            self.assertEqual(result.dtype, expected.dtype)
+            np.testing.assert_array_equal(result, expected, func.name)
+
+    def testProcessTileWithoutQABand(self):
+        from osgeo import gdal
+        from datacubeplugin.mosaic import processTile
+        from datacubeplugin.mosaicfunctions import GeoMedian, Medoid, Median
+        bandNames = ["red", "green", "blue"]
+        folder = self.folder
+        rng = np.random.RandomState(0)
+        files = []
+        for i in range(4):
+            filename = os.path.join(folder, "%i.tif" % i)
+            ds = gdal.GetDriverByName("GTiff").Create(filename, 11, 9, len(bandNames), gdal.GDT_Int16)
+            ds.SetGeoTransform((0, 30, 0, 270, 0, -30))
+            for band in range(len(bandNames)):
+                ds.GetRasterBand(band + 1).WriteArray(rng.randint(0, 5000, (9, 11)).astype(np.int16))
+            del ds
+            files.append(filename)
+        for func in [GeoMedian(), Medoid(), Median()]:
+            dstFilename = os.path.join(folder, "mosaic.tif")
+            processTile(func, files, bandNames, None, None, dstFilename)
+            ds = gdal.Open(dstFilename)
+            self.assertEqual(ds.RasterCount, len(bandNames))
+            del ds
+
+    def testMosaicWriter(self):
+        from osgeo import gdal
+        from datacubeplugin.mosaic import MosaicWriter
+        def writeTile(name, data, xmin, ymax, dataType):
+            filename = os.path.join(self.folder, name)
+            ds = gdal.GetDriverByName("GTiff").Create(filename, data.shape[1], data.shape[0], 1, dataType)
+            ds.SetGeoTransform((xmin, 30, 0, ymax, 0, -30))
+            ds.GetRasterBand(1).WriteArray(data)
+            del ds
+            return filename
+        rng = np.random.RandomState(0)
+        tiles = [rng.randint(0, 5000, (16, 16)).astype(np.int16) for i in range(2)]
+        writer = MosaicWriter(os.path.join(self.folder, "mosaic.tif"), (0, 0, 960, 960), 16)
+        '''Tiles are written in any order, at their offset in the whole extent'''
+        writer.write(writeTile("1_1.tif", tiles[1], 480, 480, gdal.GDT_Int16))
+        writer.write(writeTile("0_0.tif", tiles[0], 0, 960, gdal.GDT_Int16))
+        ds = gdal.Open(writer.close())
+        self.assertEqual(ds.GetGeoTransform(), (0, 30, 0, 960, 0, -30))
+        data = ds.GetRasterBand(1).ReadAsArray()
+        self.assertEqual(data.shape, (32, 32))
+        self.assertTrue(np.array_equal(data[:16, :16], tiles[0]))
+        self.assertTrue(np.array_equal(data[16:, 16:], tiles[1]))
+        '''Overviews are built down to the size of a block'''
+        self.assertEqual(ds.GetRasterBand(1).GetOverviewCount(), 1)
+        self.assertEqual(ds.GetMetadataItem("COMPRESSION", "IMAGE_STRUCTURE"), "DEFLATE")
+        self.assertEqual(ds.GetMetadataItem("PREDICTOR", "IMAGE_STRUCTURE"), "2")
+        del ds
+        writer = MosaicWriter(os.path.join(self.folder, "floatmosaic.tif"), (0, 480, 480, 960), 16)
+        writer.write(writeTile("float.tif", tiles[0].astype(np.float32), 0, 960, gdal.GDT_Float32))
+        ds = gdal.Open(writer.close())
+        self.assertEqual(ds.GetMetadataItem("PREDICTOR", "IMAGE_STRUCTURE"), "3")
+        self.assertEqual(ds.GetRasterBand(1).GetOverviewCount(), 0)
+        del ds
+
+    def testResumedMosaicState(self):
+        from datacubeplugin.mosaic import _saveStates, _loadStates
+        from datacubeplugin.mosaicfunctions import MostRecent, TemporalStatistics
+        from datacubeplugin.qamasks import qaMaskFromRule
+        values, qa = self._randomStack()
+        mask = qaMaskFromRule("cfmask").validMask(qa)
+        filename = os.path.join(self.folder, "state.npz")
+        for func in [MostRecent(), TemporalStatistics()]:
+            state = func.startState(values[0].shape, values[0].dtype)
+            for v, valid in zip(values[:3], mask[:3]):
+                func.accumulate(state, v, valid)
+            _saveStates(filename, [state], mask[:3].sum(axis=0))
+            states, count = _loadStates(filename)
+            for v, valid in zip(values[3:], mask[3:]):
+                func.accumulate(states[0], v, valid)
+            count = count + mask[3:].sum(axis=0)
+            self.assertTrue(np.allclose(func.stateResult(states[0], count), func.compute(values, mask), rtol=1e-5))
+
+    def testGroupByPeriod(self):
+        from dateutil import parser
+        from datacubeplugin.utils import groupByPeriod
+        dates = [parser.parse(d) for d in ["2017-01-05", "2017-01-21", "2017-02-06", "2017-04-11", "2018-03-02"]]
+        self.assertEqual(groupByPeriod(dates, "month"),
+                         [("2017-01", 0, 2), ("2017-02", 2, 3), ("2017-04", 3, 4), ("2018-03", 4, 5)])
+        self.assertEqual(groupByPeriod(dates, "quarter"), [("2017-Q1", 0, 3), ("2017-Q2", 3, 4), ("2018-Q1", 4, 5)])
+        self.assertEqual(groupByPeriod(dates, "year"), [("2017", 0, 4), ("2018", 4, 5)])
+        starts = [parser.parse(d) for d in ["2017-01-10", "2017-03-01"]]
+        self.assertEqual(groupByPeriod(dates, "custom", starts), [("2017-01-10", 1, 3), ("2017-03-01", 3, 5)])
+
+    def testPlotParameterArrays(self):
+        from qgis.core import QgsPoint
+        from datacubeplugin.plotparams import getParameters
+        from datacubeplugin.qamasks import qaMaskFromRule
+        values, qa = self._randomStack(times=6)
+        bands = ["blue", "green", "red", "nir", "swir1", "swir2", "pixel_qa"]
+        roi = [np.abs(v) + 1 for v in values] + [qa[0]]
+        for parameter in getParameters(bands, qaMaskFromRule("cfmask")):
+            try:
+                result = parameter.maskedArray(roi, bands)
+            except NotImplementedError:
+                continue
+            for row in xrange(result.shape[0]):
+                for col in xrange(result.shape[1]):
+                    value = parameter.value(roi, QgsPoint(col, row), bands)
+                    if value is None:
+                        self.assertTrue(np.isnan(result[row, col]))
+                    else:
+                        self.assertAlmostEqual(result[row, col], value, delta=1e-5 * max(1, abs(value)))
+
+    def testEVI(self):
+        from qgis.core import QgsPoint
+        from datacubeplugin.plotparams import EVI
+        bands = ["blue", "red", "nir"]
+        values = [np.full((2, 2), v) for v in (0.1, 0.2, 0.5)]
+        expected = 2.5 * (0.5 - 0.2) / (0.5 + 6 * 0.2 - 7.5 * 0.1 + 1)
+        self.assertAlmostEqual(EVI().value(values, QgsPoint(1, 1), bands), expected)
+        self.assertTrue(np.allclose(EVI().array(values, bands), expected))
+
+    def testMaxNDVI(self):
+        from datacubeplugin.mosaicfunctions import MaxIndex
+        from datacubeplugin.plotparams import NDVI
+        values, qa = self._randomStack()
+        names = ["red", "nir"]
+        stack = np.array([values, values[::-1]])
+        mask = np.ones(stack.shape[1:], dtype=bool)
+        mask[0] = False
+        red, nir = MaxIndex(NDVI()).compute(stack, mask, names)
+        ndvi = NDVI().array(stack, names)
+        ndvi[np.isnan(ndvi)] = np.finfo(np.float32).min
+        ndvi[~mask] = -np.inf
+        best = np.argmax(ndvi, axis=0)
+        for y in xrange(best.shape[0]):
+            for x in xrange(best.shape[1]):
+                self.assertEqual(red[y, x], stack[0, best[y, x], y, x])
+                self.assertEqual(nir[y, x], stack[1, best[y, x], y, x])
+
+    def testWaterFrequency(self):
+        from datacubeplugin.mosaicfunctions import WaterFrequency
+        from datacubeplugin.plotparams import WOFS
+        from datacubeplugin.qamasks import qaMaskFromRule
+        values, qa = self._randomStack()
+        mask = qaMaskFromRule("cfmask").validMask(qa)
+        names = ["blue", "green", "red", "nir", "swir1", "swir2"]
+        stack = np.array([np.roll(values, i, axis=0) for i in range(len(names))])
+        func = WaterFrequency()
+        frequency, = func.compute(stack, mask, names)
+        state = func.startState(stack[:, 0].shape, stack.dtype)
+        for t in xrange(stack.shape[1]):
+            func.accumulate(state, stack[:, t], mask[t], names)
+        self.assertTrue(np.array_equal(func.stateResult(state, mask.sum(axis=0))[0], frequency))
+        water = WOFS().array(stack, names)
+        rows, cols = np.nonzero(mask.all(axis=0) & ~np.isnan(water).any(axis=0))
+        for y, x in zip(rows, cols):
+            self.assertAlmostEqual(frequency[y, x], water[:, y, x].mean(), places=6)
+
+    def testNNLS(self):
+        from datacubeplugin.plotparams import nnls, unmixingModel
+        rng = np.random.RandomState(0)
+        A, factorizations = unmixingModel()
+        B = rng.uniform(-1, 1, (A.shape[0], 1000))
+        x = nnls(A, B, factorizations)
+        '''Karush-Kuhn-Tucker conditions of the problem'''
+        gradient = A.T.dot(A.dot(x) - B)
+        self.assertTrue(np.all(x >= 0))
+        self.assertTrue(np.all(gradient >= -1e-9))
+        self.assertTrue(np.allclose(gradient[x > 0], 0, atol=1e-9))
+
+    def _finishedJob(self, parameters, folder, states=True):
+        from datacubeplugin.jobs import MosaicJob
+        job = MosaicJob(parameters, folder)
+        outputFile = os.path.join(job.subfolder(), "mosaic.tif")
+        open(outputFile, "w").close()
+        statesFolder = job.subfolder("states") if states else None
+        job.finish(outputFile, keep=[statesFolder])
+        return job
+
+    def testResumedMosaicJob(self):
+        from datacubeplugin.jobs import MosaicJob
+        folder = self.folder
+        parameters = {"layers": [["2017-01-01", "a"], ["2017-02-01", "b"]], "function": "Median"}
+        job = MosaicJob(parameters, folder)
+        inputs = [os.path.join(job.subfolder("inputs"), "%i_0.tif" % i) for i in range(2)]
+        for filename in inputs:
+            open(filename, "w").close()
+            job.setInputDone(filename)
+        os.remove(inputs[1])
+        job.save(force=True)
+        resumed = MosaicJob(parameters, folder)
+        self.assertTrue(resumed.isResumed())
+        self.assertTrue(resumed.isInputDone(inputs[0]))
+        self.assertFalse(resumed.isInputDone(inputs[1]))
+        self.assertFalse(MosaicJob(dict(parameters, function="Medoid"), folder).isResumed())
+        outputFile = os.path.join(job.folder, "mosaic.tif")
+        open(outputFile, "w").close()
+        statesFolder = job.subfolder("states")
+        job.finish(outputFile, keep=[statesFolder, None])
+        self.assertEqual(sorted(os.listdir(job.folder)), ["manifest.json", "mosaic.tif", "states"])
+        finished = MosaicJob(parameters, folder)
+        self.assertEqual(finished.finishedOutput(), outputFile)
+        self.assertFalse(finished.isResumed())
+
+    def testFindBaseJob(self):
+        from datacubeplugin.jobs import findBaseJob
+        folder = self.folder
+        layers = [[str(2010 + i), str(i)] for i in range(4)]
+        parameters = {"layers": layers, "function": "Most recent"}
+        self.assertIsNone(findBaseJob(parameters, folder))
+        self._finishedJob(dict(parameters, layers=layers[:1]), folder)
+        base = self._finishedJob(dict(parameters, layers=layers[:2]), folder)
+        '''Jobs with more layers, but without states, other layers or other parameters'''
+        self._finishedJob(dict(parameters, layers=layers[:3]), folder, states=False)
+        self._finishedJob(dict(parameters, layers=layers[:2] + [["2020", "x"]]), folder)
+        self._finishedJob(dict(parameters, layers=layers[:3], function="Least recent"), folder)
+        self._finishedJob(parameters, folder)
+        self.assertEqual(findBaseJob(parameters, folder).id, base.id)
+
+    def testEvictJobs(self):
+        import time
+        from datacubeplugin.jobs import evictJobs
+        folder = self.folder
+        now = time.time()
+        paths = []
+        for i in range(4):
+            path = os.path.join(folder, str(i))
+            os.makedirs(path)
+            with open(os.path.join(path, "mosaic.tif"), "wb") as f:
+                f.write("0" * 100)
+            manifest = os.path.join(path, "manifest.json")
+            open(manifest, "w").close()
+            '''Job 0 is the least recently used one, and job 3 the most recent one'''
+            os.utime(manifest, (now - 100 + i, now - 100 + i))
+            paths.append(path)
+        self.assertEqual(evictJobs(400, folder=folder), 0)
+        self.assertEqual(evictJobs(250, keep=[paths[0]], folder=folder), 2)
+        self.assertEqual(sorted(os.listdir(folder)), ["0", "3"])
+        self.assertEqual(evictJobs(0, folder=folder), 2)
+        self.assertEqual(os.listdir(folder), [])
+
+    def testTileGrid(self):
+        from qgis.core import QgsPoint, QgsRectangle
+        from datacubeplugin.connectors import Layer
+        class Raster():
+            def extent(self):
+                return QgsRectangle(QgsPoint(0.3, 0.2), QgsPoint(1.3, 0.9))
+            def rasterUnitsPerPixelX(self):
+                return 0.1
+            def rasterUnitsPerPixelY(self):
+                return 0.1
+        class GridLayer(Layer):
+            TILESIZE = 4
+            def layer(self):
+                return Raster()
+        def tiles(xmin, ymin, xmax, ymax):
+            return [(index, (t.xMinimum(), t.yMinimum(), t.xMaximum(), t.yMaximum()))
+                    for index, t in GridLayer().tiles(QgsRectangle(QgsPoint(xmin, ymin), QgsPoint(xmax, ymax)))]
+        '''The layer is 10x7 pixels, so tiles in the right and bottom edges are clipped'''
+        result = dict(tiles(0.3, 0.2, 1.3, 0.9))
+        self.assertEqual(sorted(result), [(x, y) for x in range(3) for y in range(2)])
+        for index, expected in [((0, 0), (0.3, 0.5, 0.7, 0.9)), ((2, 0), (1.1, 0.5, 1.3, 0.9)),
+                                ((0, 1), (0.3, 0.2, 0.7, 0.5)), ((2, 1), (1.1, 0.2, 1.3, 0.5))]:
+            for v, e in zip(result[index], expected):
+                self.assertAlmostEqual(v, e)
+        '''Extents on tile boundaries don't add tiles due to floating point errors'''
+        self.assertEqual([index for index, _ in tiles(0.3 + 0.4, 0.9 - 0.4, 0.3 + 0.8, 0.9)], [(1, 0)])
+        '''Tiles are the same for extents that are not aligned with them'''
+        result = tiles(-5, -5, 0.35, 0.85)
+        self.assertEqual([index for index, _ in result], [(0, 0), (0, 1)])
+        for v, e in zip(result[0][1], (0.3, 0.5, 0.7, 0.9)):
+            self.assertAlmostEqual(v, e)
+        self.assertEqual(tiles(2, 2, 3, 3), [])
+
+    def testReadBands(self):
+        from osgeo import gdal
+        from datacubeplugin.readers import DatasetPool
+        data = np.arange(3 * 9 * 11, dtype=np.int16).reshape(3, 9, 11)
+        filename = os.path.join(self.folder, "bands.tif")
+        ds = gdal.GetDriverByName("GTiff").Create(filename, 11, 9, 3, gdal.GDT_Int16)
+        for band in range(3):
+            ds.GetRasterBand(band + 1).WriteArray(data[band])
+        del ds
+        class Dataset():
+            '''Wraps a dataset, failing to read it as older GDAL versions or broken files do'''
+            def __init__(self, ds, error):
+                self.ds = ds
+                self.error = error
+            def __getattr__(self, name):
+                return getattr(self.ds, name)
+            def ReadAsArray(self, *args, **kwargs):
+                if self.error == "band_list" and "band_list" in kwargs:
+                    raise TypeError()
+                if self.error == "read":
+                    return None
+                return self.ds.ReadAsArray(*args, **kwargs)
+        class Pool(DatasetPool):
+            error = None
+            def dataset(self, filename):
+                return Dataset(DatasetPool.dataset(self, filename), self.error)
+        pool = Pool()
+        for error in [None, "band_list"]:
+            pool.error = error
+            self.assertTrue(np.array_equal(pool.readBands(filename), data))
+            self.assertTrue(np.array_equal(pool.readBands(filename, [3, 1]), data[[2, 0]]))
+            self.assertTrue(np.array_equal(pool.readBands(filename, [2], window=(3, 2, 4, 5)),
+                                           data[1:2, 2:7, 3:7]))
+        pool.error = "read"
+        self.assertRaises(IOError, pool.readBands, filename)
+        pool.error = None
+        pool.close()
+        self.assertTrue(np.array_equal(pool.readStack([filename] * 80, [1])[:, 0], [data[0]] * 80))
+        self.assertEqual(pool.maxSize, 80)
+
+    def testTileCache(self):
+        import time
+        from datacubeplugin.cache import TileCache
+        folder = self.folder
+        cache = TileCache(os.path.join(folder, "tiles.sqlite"), 250)
+        filename = os.path.join(folder, "tile.tif")
+        def put(name, content):
+            with open(filename, "wb") as f:
+                f.write(content * 100)
+            cache.put(("url", "coverage", "time", name), filename)
+            '''Tiles are evicted by their last access time, so it must be different for each one'''
+            time.sleep(0.01)
+        put("a", "a")
+        put("b", "b")
+        self.assertTrue(cache.get(("url", "coverage", "time", "a"), filename))
+        time.sleep(0.01)
+        put("c", "c")
+        self.assertFalse(cache.get(("url", "coverage", "time", "b"), filename))
+        self.assertTrue(cache.get(("url", "coverage", "time", "c"), filename))
+        self.assertTrue(cache.get(("url", "coverage", "time", "a"), filename))
+        with open(filename, "rb") as f:
+            self.assertEqual(f.read(), "a" * 100)
+        self.assertEqual(cache.stats(), {"hits": 3, "misses": 1, "count": 2, "size": 200})
+        cache.clear()
+        self.assertEqual(cache.stats(), {"hits": 0, "misses": 0, "count": 0, "size": 0})
+
+    def testValuesCache(self):
+        from datacubeplugin.cache import ValuesCache
+        cache = ValuesCache(200)
+        cache.put("a", np.zeros(10))
+        cache.put("b", [np.zeros(5), np.zeros(5)])
+        self.assertIsNotNone(cache.get("a"))
+        cache.put("c", np.zeros(10))
+        self.assertIsNone(cache.get("b"))
+        self.assertIsNotNone(cache.get("a"))
+        cache.put("d", np.zeros(100))
+        self.assertIsNone(cache.get("d"))
+        self.assertEqual(cache.size, 160)
+
+    def testExtractPointFromFiles(self):
+        from osgeo import gdal
+        from qgis.core import QgsPoint
+        from datacubeplugin.connectors import FileLayer, extractPoint
+        from datacubeplugin.cache import valuesCache
+        folder = os.path.join(self.folder, "dataset", "coverage")
+        os.makedirs(folder)
+        filenames = ["2017-01-01T00_00_00Z.tif", "2017-02-01T00_00_00Z.tif"]
+        data = np.arange(9 * 11, dtype=np.int16).reshape(9, 11)
+        for i, filename in enumerate(filenames):
+            ds = gdal.GetDriverByName("GTiff").Create(os.path.join(folder, filename), 11, 9, 3, gdal.GDT_Int16)
+            ds.SetGeoTransform((1000, 30, 0, 2000, 0, -30))
+            for band in range(3):
+                ds.GetRasterBand(band + 1).WriteArray(data * (band + 1) + i)
+            del ds
+        class Coverage():
+            bands = ["red", "nir", "blue"]
+        class CountingLayer(FileLayer):
+            '''Counts the reads, to check that cached values are not read again'''
+            reads = 0
+            def windowReader(self, extent, crs=None):
+                CountingLayer.reads += 1
+                return FileLayer.windowReader(self, extent, crs)
+        layers = [CountingLayer(folder, filename, Coverage()) for filename in filenames]
+        pt = QgsPoint(1000 + 4.5 * 30, 2000 - 3.5 * 30)
+        values = extractPoint(layers, pt)
+        for filename, row in zip(filenames, values):
+            ds = gdal.Open(os.path.join(folder, filename))
+            self.assertTrue(np.array_equal(row, ds.ReadAsArray(4, 3, 1, 1)[:, 0, 0]))
+            del ds
+        self.assertEqual(CountingLayer.reads, 2)
+        extent = layers[0].pixelExtent(pt)
+        self.assertTrue(np.array_equal(valuesCache().get(layers[1].valuesKey(extent)), values[1]))
+        self.assertTrue(np.array_equal(extractPoint(layers, pt), values))
+        self.assertEqual(CountingLayer.reads, 2)
+        self.assertTrue(np.isnan(extractPoint(layers, QgsPoint(0, 0))).all())
+
+    def testQAMask(self):
+        from datacubeplugin.qamasks import qaMaskFromRule
+        values, qa = self._randomStack()
+        for rule in ["cfmask", "pixel_qa_snow", '{"invalidValues": [1], "invalidBits": [0, "snow"]}']:
+            qaMask = qaMaskFromRule(rule)
+            expected = np.vectorize(qaMask.isValid)(np.array(qa))
+            self.assertTrue(np.array_equal(qaMask.validMask(qa), expected))
+            self.assertTrue(np.array_equal(qaMask.validMask(np.array(qa, dtype=np.int32)), expected))
+        for rule in ["clouds", '{"invalidBits": ["clouds"]}', '{"invalidBits": [16]}', "[2, 4]"]:
+            self.assertRaises(ValueError, qaMaskFromRule, rule)
+
 
 def pluginSuite():
     suite = unittest.TestSuite()
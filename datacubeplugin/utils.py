@@ -1,11 +1,17 @@
 from qgis.core import QgsProject, QgsMapLayerRegistry, QgsLayerTreeGroup, QgsMultiBandColorRenderer
+from qgis.gui import QgsMessageBar
 from qgis.utils import iface
 from datetime import timedelta
 from dateutil import parser
 from datacubeplugin import layers
+from datacubeplugin.qamasks import qaMaskFromRule, DEFAULT_RULE
 from qgiscommons2.gui import execute
+from qgiscommons2.settings import pluginSetting
+import logging
 
-def addLayerIntoGroup(layer, name, coverageName, bands=None):
+logger = logging.getLogger('datacube')
+
+def addLayerIntoGroup(layer, name, coverageName, bands=None, rgb=None):
     root = QgsProject.instance().layerTreeRoot()
     group = None
     for child in root.children():
@@ -17,9 +23,14 @@ def addLayerIntoGroup(layer, name, coverageName, bands=None):
     QgsMapLayerRegistry.instance().addMapLayer(layer, False)
     group.addLayer(layer)
 
+    if rgb is None:
+        rgb = rgbBands(name, coverageName, bands)
+    setLayerRGB(layer, *rgb)
+
+def rgbBands(name, coverageName, bands):
+    '''Returns the indices of the bands used to render the layers of a coverage'''
     try:
-        r, g, b = layers._rendering[name][coverageName]
-        setLayerRGB(layer, r, g, b)
+        return layers._rendering[name][coverageName]
     except KeyError, e:
         if len(bands) > 2:
             try:
@@ -28,11 +39,10 @@ def addLayerIntoGroup(layer, name, coverageName, bands=None):
                 b = bands.index("blue")
             except ValueError:
                 r, g, b = 0, 1, 2
-            layers._rendering[name][coverageName] = (r,g,b)
-            setLayerRGB(layer, r, g, b)
         else:
-            layers._rendering[name][coverageName] = (0,0,0)
-            setLayerRGB(layer, 0, 0, 0)
+            r, g, b = 0, 0, 0
+        layers._rendering[name][coverageName] = (r,g,b)
+        return r, g, b
 
 MINDATE = parser.parse("1800-01-01T00:00:00")
 
@@ -44,9 +54,52 @@ def dateFromDays(days):
     delta = timedelta(days)
     return MINDATE + delta
 
+PERIODS = ["month", "quarter", "year", "custom"]
+
+def groupByPeriod(dates, period, starts=None):
+    '''
+    Groups a sorted list of dates into consecutive periods. period is one of the
+    PERIODS, and for custom periods, the sorted list of their start dates must be
+    passed, each period lasting until the start of the next one. Dates before the
+    first start are not used. Returns a list of (name, first, last) tuples, with the
+    name of each period and the range of the indices of its dates, for the periods
+    that contain any date
+    '''
+    groups = []
+    for i, d in enumerate(dates):
+        d = d.replace(tzinfo=None)
+        if period == "month":
+            name = "%i-%02i" % (d.year, d.month)
+        elif period == "quarter":
+            name = "%i-Q%i" % (d.year, (d.month - 1) // 3 + 1)
+        elif period == "year":
+            name = str(d.year)
+        else:
+            previous = [s for s in starts if s <= d]
+            if not previous:
+                continue
+            name = str(previous[-1]).split(" ")[0]
+        if groups and groups[-1][0] == name:
+            groups[-1][2] = i + 1
+        else:
+            groups.append([name, i, i + 1])
+    return [tuple(g) for g in groups]
+
 def setLayerRGB(layer, r, g, b):
     renderer = QgsMultiBandColorRenderer(layer.dataProvider(), r + 1, g + 1, b + 1)
     layer.setRenderer(renderer)
     layer.setDefaultContrastEnhancement()
     layer.triggerRepaint()
-    iface.legendInterface().refreshLayerSymbology(layer)
\ No newline at end of file
+    iface.legendInterface().refreshLayerSymbology(layer)
+
+def qaMaskForCoverage(coverage):
+    '''Returns the QA mask of a coverage, using its own rule or the one in the plugin
+    settings. If the rule is not valid, the user is warned and the default rule is used'''
+    rule = getattr(coverage, "qaRule", None) or pluginSetting("qaRule")
+    try:
+        return qaMaskFromRule(rule)
+    except ValueError, e:
+        logger.warning("Wrong QA masking rule %s: %s" % (rule, e))
+        iface.messageBar().pushMessage("", "Wrong QA masking rule: %s. Using the default one (%s)" % (rule, DEFAULT_RULE),
+                                       level=QgsMessageBar.WARNING)
+        return qaMaskFromRule(DEFAULT_RULE)